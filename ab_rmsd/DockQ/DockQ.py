@@ -6,6 +6,8 @@ from Bio import BiopythonWarning
 warnings.simplefilter("ignore", BiopythonWarning)
 import sys
 import os
+import io
+import gzip
 import re
 import tempfile
 import numpy as np
@@ -14,7 +16,12 @@ from math import sqrt
 from argparse import ArgumentParser
 import itertools
 import subprocess
+import shutil
+import threading
+import contextlib
 from typing import List
+from ab_rmsd import timing
+from ab_rmsd.utils.protein.pdb_reader import open_structure, read_structure
 
 def parse_fnat(fnat_out):
     fnat = -1
@@ -112,6 +119,63 @@ def capri_class_DockQ(DockQ, capri_peptide=False):
         return "Undef"
 
 
+def _write_pdb_text(path, fmt, fd):
+    # plain pdb text is decompressed into the pipe chunk by chunk, mmcif is converted as a whole.
+    out = open(fd, "wb")
+    try:
+        if fmt == "cif":
+            text = io.StringIO()
+            pdb_io = Bio.PDB.PDBIO()
+            pdb_io.set_structure(read_structure(path))
+            pdb_io.save(text)
+            out.write(text.getvalue().encode())
+        else:
+            f, _ = open_structure(path)
+            with f:
+                shutil.copyfileobj(f, out)
+    except BrokenPipeError:
+        pass  # fnat stopped reading
+    finally:
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
+
+
+@contextlib.contextmanager
+def fnat_input(path):
+    """
+    path to give the fnat binary for `path`, which only reads uncompressed pdb files.
+    other inputs (.pdb.gz, .cif, .cif.gz) are streamed as pdb text through a pipe, no temporary file is written.
+
+    Yields:
+        tuple: path for fnat, and the file descriptors the fnat process must inherit.
+    """
+    f, fmt = open_structure(path)
+    f.close()
+    if fmt == "pdb" and not isinstance(f, gzip.GzipFile):
+        yield path, ()
+        return
+    r, w = os.pipe()
+    writer = threading.Thread(target=_write_pdb_text, args=(path, fmt, w), daemon=True)
+    writer.start()
+    try:
+        yield "/dev/fd/%d" % r, (r,)
+    finally:
+        os.close(r)
+        writer.join()
+
+
+@timing.timed("fnat")
+def run_fnat(exec_path, model, native, args):
+    """run the fnat binary on `model` and `native`, return its output."""
+    with fnat_input(model) as (model_in, model_fds), fnat_input(native) as (native_in, native_fds):
+        cmd = exec_path + "/fnat " + model_in + " " + native_in + " " + args
+        return subprocess.run(
+            cmd, shell=True, stdout=subprocess.PIPE, text=True, pass_fds=model_fds + native_fds
+        ).stdout
+
+
 def calc_DockQ(model, native, use_CA_only=False, capri_peptide=False):
 
     #    exec_path=os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -122,12 +186,14 @@ def calc_DockQ(model, native, use_CA_only=False, capri_peptide=False):
 
     cmd_fnat = exec_path + "/fnat " + model + " " + native + " 5 -all"
     cmd_interface = exec_path + "/fnat " + model + " " + native + " 10 -all"
+    fnat_args, interface_args = "5 -all", "10 -all"
 
     if capri_peptide:
         cmd_fnat = exec_path + "/fnat " + model + " " + native + " 4 -all"
         cmd_interface = exec_path + "/fnat " + model + " " + native + " 8 -cb"
+        fnat_args, interface_args = "4 -all", "8 -cb"
 
-    fnat_out = os.popen(cmd_fnat).read()
+    fnat_out = run_fnat(exec_path, model, native, fnat_args)
 
     # fnat_out = subprocess.getoutput(cmd_fnat)
     # print(fnat_out)
@@ -142,7 +208,7 @@ def calc_DockQ(model, native, use_CA_only=False, capri_peptide=False):
         interface5A,
     ) = parse_fnat(fnat_out)
     assert fnat != -1, "Error running cmd: %s\n" % (cmd_fnat)
-    inter_out = os.popen(cmd_interface).read()
+    inter_out = run_fnat(exec_path, model, native, interface_args)
     #   inter_out = subprocess.getoutput(cmd_interface)
 
     (
@@ -160,12 +226,9 @@ def calc_DockQ(model, native, use_CA_only=False, capri_peptide=False):
     # Use same interface as for fnat for iRMS
     # interface=interface5A
 
-    # Start the parser
-    pdb_parser = Bio.PDB.PDBParser(QUIET=True)
-
-    # Get the structures
-    ref_structure = pdb_parser.get_structure("reference", native)
-    sample_structure = pdb_parser.get_structure("model", model)
+    # Get the structures, .pdb / .cif, gzip compressed or not
+    ref_structure = read_structure(native, "reference")
+    sample_structure = read_structure(model, "model")
 
     # Use the first model in the pdb-files for alignment
     # Change the number 0 if you want to align to another structure
@@ -427,8 +490,7 @@ def calc_DockQ(model, native, use_CA_only=False, capri_peptide=False):
 
 
 def get_pdb_chains(pdb):
-    pdb_parser = Bio.PDB.PDBParser(QUIET=True)
-    pdb_struct = pdb_parser.get_structure("reference", pdb)[0]
+    pdb_struct = read_structure(pdb, "reference")[0]
     chain = []
     for c in pdb_struct:
         chain.append(c.id)
@@ -440,8 +502,7 @@ def get_pdb_chains(pdb):
 
 
 def make_two_chain_pdb(pdb, group1, group2):  # renumber from 1
-    pdb_parser = Bio.PDB.PDBParser(QUIET=True)
-    pdb_struct = pdb_parser.get_structure("reference", pdb)[0]
+    pdb_struct = read_structure(pdb, "reference")[0]
     for c in pdb_struct:
         if c.id in group1:
             c.id = "A"
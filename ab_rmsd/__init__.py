@@ -1,2 +1,24 @@
-from ab_rmsd.calc_rmsd import calc_ab_rmsd
-from ab_rmsd.DockQ.DockQ import calc_DockQ 
+"""
+entry points are imported on first access, `import ab_rmsd` alone does not load
+the rmsd path (torch, Biopython) or DockQ.
+"""
+import importlib
+
+_LAZY_ATTRS = {
+    "calc_ab_rmsd": "ab_rmsd.calc_rmsd",
+    "calc_ab_rmsd_ensemble": "ab_rmsd.calc_rmsd",
+    "calc_DockQ": "ab_rmsd.DockQ.DockQ",
+}
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
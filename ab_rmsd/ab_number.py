@@ -1,9 +1,49 @@
 import argparse
-import abnumber
+import os
+import re
 from Bio import PDB
 from Bio.PDB import Model, Chain, Residue, Selection
 from Bio.Data import SCOPData
 from typing import List, Tuple
+import numpy as np
+from ab_rmsd import timing
+from ab_rmsd.number_store import number_store
+from ab_rmsd.utils.protein.pdb_reader import (
+    chain_ids_in_order,
+    read_pdb_atoms,
+    read_structure,
+    residue_ordinals,
+    residue_starts,
+    select_atoms,
+)
+
+
+# set `AB_RMSD_FORCE_RENUMBER=1` to number every chain with ANARCI, see `existing_chothia_numbering`.
+FORCE_RENUMBER = os.environ.get("AB_RMSD_FORCE_RENUMBER", "0") != "0"
+
+# conserved (resseq, residue) of Chothia numbered variable domains
+CHOTHIA_ANCHORS = {
+    "heavy": ((22, "C"), (36, "W"), (92, "C"), (103, "W")),
+    "light": ((23, "C"), (35, "W"), (88, "C"), (98, "F")),
+}
+# positions ANARCI puts Chothia insertion codes on
+CHOTHIA_INSERTIONS = {"heavy": (6, 31, 52, 82, 100), "light": (30, 52, 68, 95)}
+# last position of the variable domain
+CHOTHIA_FV_END = {"heavy": 113, "light": 107}
+
+# chains scoring below this in `ig_likeness` are not aligned with ANARCI, `AB_RMSD_IG_FILTER=0` aligns every chain.
+IG_FILTER_THRESHOLD = float(os.environ.get("AB_RMSD_IG_FILTER", "0.5"))
+# shortest sequence that can hold a variable domain
+MIN_FV_LENGTH = 70
+# most frequent framework 4-mers of the heavy, kappa and lambda V and J germlines of ANARCI
+IG_KMERS = (
+    "YYCA", "GLEW", "VYYC", "AVYY", "YCAR", "KGLE", "GKGL", "FSGS", "RFSG", "PGKG", "WVRQ",
+    "DTAV", "WYQQ", "TAVY", "EDTA", "LEWI", "QAPG", "QVQL", "RQAP", "EWIG", "VRQA", "LTIS",
+    "LVKP", "FTIS", "TVSS", "WGQG", "GQGT", "GTKL", "FGGG", "GGGT", "KLEI", "LTVL",
+)
+# J segment, H103 Trp / L98 Phe, Gly, Xaa, Gly
+_J_MOTIF = re.compile(r"(?=[FW]G.G)")
+NON_IG_ERROR = "Not an immunoglobulin chain (pre-filter)"
 
 
 def biopython_chain_to_sequence(chain: Chain.Chain):
@@ -14,8 +54,23 @@ def biopython_chain_to_sequence(chain: Chain.Chain):
     return seq, residue_list
 
 
-def assign_number_to_sequence(seq):
-    abchain = abnumber.Chain(seq, scheme="chothia")
+class NumberingError(Exception):
+    """
+    the sequence does not contain a valid Fv.
+    raised in place of `abnumber.ChainParseError`, so that abnumber (and ANARCI)
+    is only imported when a sequence is actually aligned.
+    """
+
+
+def assign_number_to_sequence(seq, scheme="chothia"):
+    import abnumber
+
+    abchain = abnumber.Chain(seq, scheme=scheme)
+    return _chain_numbers(seq, abchain), abchain
+
+
+def _chain_numbers(seq, abchain):
+    """(resseq, icode) of every residue of `seq` from its `abnumber.Chain`, None outside the Fv."""
     offset = seq.index(abchain.seq)
     if not (offset >= 0):
         raise ValueError(
@@ -27,7 +82,262 @@ def assign_number_to_sequence(seq):
         resseq = pos.number
         icode = pos.letter if pos.letter else " "
         numbers[i + offset] = (resseq, icode)
-    return numbers, abchain
+    return numbers
+
+
+def ig_likeness(seq):
+    """
+    cheap evidence that `seq` contains an immunoglobulin variable domain, without an alignment:
+    the spacing of the conserved Cys (H22 / L23), Trp (H36 / L35), Cys (H92 / L88) and J motif,
+    and the conserved framework k-mers `IG_KMERS`, which also find domains that lost an anchor.
+
+    Returns:
+        float: in [0, 1], the larger of the fraction of the 3 spacings and of 4 k-mers found.
+            0 for sequences shorter than a variable domain.
+    """
+    if len(seq) < MIN_FV_LENGTH:
+        return 0.0
+    hits = 0
+    for kmer in IG_KMERS:
+        if kmer in seq:
+            hits += 1
+            if hits == 4:
+                return 1.0
+    aa = np.frombuffer(seq.encode(), dtype=np.uint8)
+    cys = np.flatnonzero(aa == ord("C"))
+    trp = np.flatnonzero(aa == ord("W"))
+    j_motif = np.array([m.start() for m in _J_MOTIF.finditer(seq)], dtype=np.int64)
+    spacings = 0
+    for c in cys:
+        # CDR1 between the first Cys and the Trp, CDR1 / CDR2 within the disulfide, CDR3 before the J motif
+        found = int(np.any((trp >= c + 11) & (trp <= c + 20)))
+        c2 = cys[(cys >= c + 60) & (cys <= c + 85)]
+        if len(c2) > 0:
+            found += 1
+            found += int(np.any((j_motif[:, None] >= c2 + 5) & (j_motif[:, None] <= c2 + 35)))
+        spacings = max(spacings, found)
+    return max(spacings / 3, hits / 4)
+
+
+def is_non_ig(seq):
+    """
+    True if `ig_likeness` of `seq` is below `IG_FILTER_THRESHOLD`, such chains are not aligned.
+    chains scoring at or above the threshold get the full ANARCI check.
+    """
+    if IG_FILTER_THRESHOLD <= 0 or ig_likeness(seq) >= IG_FILTER_THRESHOLD:
+        return False
+    timing.count("non_ig_skipped")
+    return True
+
+
+def number_sequence(seq, scheme="chothia"):
+    """
+    number `seq` and identify its chain type, looking it up in the persistent
+    `number_store` before calling ANARCI. chains that are clearly not immunoglobulins
+    (see `is_non_ig`) are not aligned.
+
+    Raises:
+        NumberingError: `seq` does not contain a valid Fv.
+
+    Returns:
+        tuple: numbers, chain_type
+    """
+    if number_store is not None:
+        cached = number_store.get(seq, scheme)
+        if cached is not None:
+            numbers, chain_type, error = cached
+            timing.count("number_store_hit")
+            if error is not None:
+                raise NumberingError(error)
+            return numbers, chain_type
+    if is_non_ig(seq):
+        raise NumberingError(NON_IG_ERROR)
+    import abnumber
+
+    try:
+        timing.count("anarci")
+        with timing.stage("number"):
+            numbers, abchain = assign_number_to_sequence(seq, scheme)
+    except abnumber.ChainParseError as e:
+        if number_store is not None:
+            number_store.put(seq, error=str(e), scheme=scheme)
+        raise NumberingError(str(e)) from e
+    if number_store is not None:
+        number_store.put(seq, numbers, abchain.chain_type, scheme=scheme)
+    return numbers, abchain.chain_type
+
+
+def existing_chothia_numbering(seq, resseq, icode):
+    """
+    the numbering a chain already has (e.g. SAbDab Chothia files), if it is consistent Chothia
+    numbering: residues in strictly increasing order, insertion codes only on the positions ANARCI
+    puts Chothia insertions on, and the conserved Cys / Trp / Phe anchors at their Chothia positions.
+    heavy and light chains are told apart by the anchors, kappa and lambda by the end of
+    the J segment (lambda ...TVL, kappa ...EIK at L105-107).
+
+    Args:
+        seq (str): one-letter sequence of the chain.
+        resseq (sequence): residue number of every residue of `seq`.
+        icode (sequence): insertion code of every residue of `seq`.
+
+    Returns:
+        tuple or None: numbers, chain_type as `number_sequence`, residues outside the variable domain
+            are not numbered. None if the chain is not Chothia numbered.
+    """
+    keys = [(int(r), str(c).strip() or " ") for r, c in zip(resseq, icode)]
+    if any(a >= b for a, b in zip(keys, keys[1:])):
+        return None
+    residues = dict(zip(keys, seq))
+    for chain, anchors in CHOTHIA_ANCHORS.items():
+        if all(residues.get((r, " ")) == aa for r, aa in anchors):
+            break
+    else:
+        return None
+    numbers = []
+    for r, c in keys:
+        if not 1 <= r <= CHOTHIA_FV_END[chain]:
+            numbers.append(None)
+            continue
+        if c != " " and r not in CHOTHIA_INSERTIONS[chain]:
+            return None
+        numbers.append((r, c))
+    if chain == "heavy":
+        chain_type = "H"
+    elif residues.get((106, " ")) == "V" or residues.get((107, " ")) == "L":
+        chain_type = "L"
+    else:
+        chain_type = "K"
+    return numbers, chain_type
+
+
+def number_chain(seq, resseq, icode, numberings=None, force_renumber=None):
+    """
+    number a chain: reuse the numbering of the same sequence from `numberings`, trust its own
+    numbering if it is already Chothia (see `existing_chothia_numbering`), or align it with
+    `number_sequence`.
+
+    Args:
+        seq (str): one-letter sequence of the chain.
+        resseq (sequence): current residue numbers.
+        icode (sequence): current insertion codes.
+        numberings (dict, optional): chain sequence -> (numbers, chain_type), see `renumber`.
+        force_renumber (bool, optional): always align with ANARCI. Defaults to `FORCE_RENUMBER`.
+
+    Raises:
+        NumberingError: `seq` does not contain a valid Fv.
+
+    Returns:
+        tuple: numbers, chain_type
+    """
+    if numberings is not None and seq in numberings:
+        timing.count("numbering_reuse")
+        return numberings[seq]
+    if force_renumber is None:
+        force_renumber = FORCE_RENUMBER
+    numbering = None if force_renumber else existing_chothia_numbering(seq, resseq, icode)
+    if numbering is not None:
+        timing.count("numbering_trusted")
+    else:
+        numbering = number_sequence(seq)
+    if numberings is not None:
+        numberings[seq] = numbering
+    return numbering
+
+
+def number_sequences(seqs, scheme="chothia"):
+    """
+    number many sequences at once. sequences found in `number_store` are not aligned again,
+    all the others are aligned by ANARCI in a single batch (one HMMER run), and stored.
+    chains that are clearly not immunoglobulins (see `is_non_ig`) are not aligned.
+
+    Args:
+        seqs (iterable): chain sequences, possibly from many files. duplicates are numbered once.
+        scheme (str, optional): Defaults to "chothia".
+
+    Returns:
+        tuple: dict seq -> (numbers, chain_type), dict seq -> error message of the sequences
+            that do not contain a valid Fv (see `NumberingError`).
+    """
+    numberings, errors = {}, {}
+    todo = []
+    for seq in dict.fromkeys(seqs):
+        cached = number_store.get(seq, scheme) if number_store is not None else None
+        if cached is None:
+            if is_non_ig(seq):
+                errors[seq] = NON_IG_ERROR
+            else:
+                todo.append(seq)
+            continue
+        timing.count("number_store_hit")
+        numbers, chain_type, error = cached
+        if error is not None:
+            errors[seq] = error
+        else:
+            numberings[seq] = (numbers, chain_type)
+    if len(todo) == 0:
+        return numberings, errors
+    import abnumber
+
+    timing.count("anarci", len(todo))
+    with timing.stage("number"):
+        abchains, batch_errors = abnumber.Chain.batch(dict(enumerate(todo)), scheme=scheme)
+    for i, seq in enumerate(todo):
+        if i in abchains:
+            try:
+                numberings[seq] = (_chain_numbers(seq, abchains[i]), abchains[i].chain_type)
+            except ValueError:
+                continue  # raised again when the sequence is numbered on its own
+            if number_store is not None:
+                number_store.put(seq, *numberings[seq], scheme=scheme)
+        else:
+            errors[seq] = batch_errors.get(i, "Variable chain sequence not recognized")
+            if number_store is not None:
+                number_store.put(seq, error=errors[seq], scheme=scheme)
+    return numberings, errors
+
+
+def chain_sequences(atoms):
+    """
+    Args:
+        atoms (EasyDict): per-atom arrays, see `pdb_reader.read_pdb_atoms`.
+
+    Yields:
+        tuple: chain id, residue indices of the chain, one-letter sequence of the chain.
+    """
+    starts = residue_starts(atoms)
+    res_chain = atoms.chain_id[starts]
+    res_name = atoms.resname[starts]
+    for chain_id in chain_ids_in_order(atoms):
+        res_idx = np.flatnonzero(res_chain == chain_id)
+        seq = "".join(
+            [SCOPData.protein_letters_3to1.get(str(r), "X") for r in res_name[res_idx]]
+        )
+        yield chain_id, res_idx, seq
+
+
+def prefetch_numbering(pdb_paths, scheme="chothia"):
+    """
+    number the chains of all `pdb_paths` with one `number_sequences` batch, so that parsing
+    the files afterwards finds every numbering in `number_store`. chains that are already
+    Chothia numbered are skipped unless `FORCE_RENUMBER`, see `number_chain`.
+    files that cannot be read are skipped, they fail again when they are parsed.
+
+    Returns:
+        tuple: see `number_sequences`.
+    """
+    seqs = []
+    for pdb_path in dict.fromkeys(pdb_paths):
+        try:
+            atoms = read_pdb_atoms(pdb_path)
+        except Exception:
+            continue
+        starts = residue_starts(atoms)
+        for _, res_idx, seq in chain_sequences(atoms):
+            if FORCE_RENUMBER or existing_chothia_numbering(
+                seq, atoms.resseq[starts][res_idx], atoms.icode[starts][res_idx]
+            ) is None:
+                seqs.append(seq)
+    return number_sequences(seqs, scheme)
 
 
 def renumber_biopython_chain(
@@ -46,7 +356,7 @@ def renumber_biopython_chain(
 
 def renumber_write(in_pdb, out_pdb, return_other_chains=False):
     """
-    read a pdb file from `in_pdb`, identify heavy and light chain id, renumber chains and write to `out_pdb`.
+    read a .pdb / .cif file, gzip compressed or not, from `in_pdb`, identify heavy and light chain id, renumber chains and write to `out_pdb`.
 
     Args:
         in_pdb (path):
@@ -67,19 +377,23 @@ def renumber_write(in_pdb, out_pdb, return_other_chains=False):
         return heavy_chains, light_chains
 
 
-def renumber(in_pdb):
+def renumber(in_pdb, numberings=None, force_renumber=None):
     """
-    read a pdb file from `in_pdb`, identify heavy, light, and other chain id,
+    read a .pdb / .cif file, gzip compressed or not, from `in_pdb`, identify heavy, light, and other chain id,
     return the model with renumbered chains and chain ids.
 
     Args:
         in_pdb (path):
+        numberings (dict, optional): maps chain sequence to (numbers, chain_type).
+            chains whose sequence is found here reuse that numbering instead of calling ANARCI,
+            newly numbered chains are added to it. Defaults to None.
+        force_renumber (bool, optional): number every chain with ANARCI, even if it is already
+            Chothia numbered, see `number_chain`. Defaults to `FORCE_RENUMBER`.
     Returns:
         tuple: renumbered_model, heavy_chain id list, light_chain id list, other_chain id list
     """
 
-    parser = PDB.PDBParser(QUIET=True)
-    structure = parser.get_structure(None, in_pdb)
+    structure = read_structure(in_pdb)
     model = structure[0]
     model_new = Model.Model(0)
 
@@ -88,13 +402,19 @@ def renumber(in_pdb):
     for chain in model:
         try:
             seq, reslist = biopython_chain_to_sequence(chain)
-            numbers, abchain = assign_number_to_sequence(seq)
+            numbers, chain_type = number_chain(
+                seq,
+                [r.id[1] for r in reslist],
+                [r.id[2] for r in reslist],
+                numberings,
+                force_renumber,
+            )
             chain_new = renumber_biopython_chain(chain.id, reslist, numbers)
-            if abchain.chain_type == "H":
+            if chain_type == "H":
                 heavy_chains.append(chain_new.id)
-            elif abchain.chain_type in ("K", "L"):
+            elif chain_type in ("K", "L"):
                 light_chains.append(chain_new.id)
-        except abnumber.ChainParseError as e:
+        except NumberingError as e:
             print(f"[INFO] Chain {chain.id} does not contain valid Fv: {str(e)}")
             chain_new = chain.copy()
             other_chains.append(chain_new.id)
@@ -102,9 +422,59 @@ def renumber(in_pdb):
     return model_new, heavy_chains, light_chains, other_chains
 
 
+def renumber_atoms(atoms, numberings=None, force_renumber=None):
+    """
+    same as `renumber`, on the per-atom arrays of `pdb_reader.read_pdb_atoms`.
+
+    Args:
+        atoms (EasyDict): per-atom arrays.
+        numberings (dict, optional): chain sequence -> (numbers, chain_type), see `renumber`.
+        force_renumber (bool, optional): see `renumber`.
+    Returns:
+        tuple: renumbered atoms, heavy_chain id list, light_chain id list, other_chain id list
+    """
+    starts = residue_starts(atoms)
+    res_resseq = atoms.resseq[starts]
+    res_icode = atoms.icode[starts]
+    new_resseq = res_resseq.copy()
+    new_icode = res_icode.copy()
+    keep = np.ones(len(starts), dtype=bool)
+
+    heavy_chains, light_chains, other_chains = [], [], []
+
+    for chain_id, res_idx, seq in chain_sequences(atoms):
+        try:
+            numbers, chain_type = number_chain(
+                seq, res_resseq[res_idx], res_icode[res_idx], numberings, force_renumber
+            )
+            for i, number in zip(res_idx, numbers):
+                if number is None:
+                    keep[i] = False
+                    continue
+                new_resseq[i], new_icode[i] = number
+            if chain_type == "H":
+                heavy_chains.append(chain_id)
+            elif chain_type in ("K", "L"):
+                light_chains.append(chain_id)
+        except NumberingError as e:
+            print(f"[INFO] Chain {chain_id} does not contain valid Fv: {str(e)}")
+            other_chains.append(chain_id)
+
+    atom_res = residue_ordinals(atoms)
+    atoms = dict(atoms)
+    atoms["resseq"] = new_resseq[atom_res]
+    atoms["icode"] = new_icode[atom_res]
+    atoms = select_atoms(atoms, keep[atom_res])
+    return atoms, heavy_chains, light_chains, other_chains
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("in_pdb", type=str)
     parser.add_argument("out_pdb", type=str)
+    parser.add_argument("--force_renumber", action="store_true", help="renumber chains that are already Chothia numbered.")
+    parser.add_argument("--ig_filter", type=float, default=IG_FILTER_THRESHOLD, help="align chains with ig_likeness at or above this with ANARCI, 0 aligns every chain.")
     args = parser.parse_args()
+    FORCE_RENUMBER = FORCE_RENUMBER or args.force_renumber
+    IG_FILTER_THRESHOLD = args.ig_filter
     renumber_write(args.in_pdb, args.out_pdb)
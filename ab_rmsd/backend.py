@@ -0,0 +1,163 @@
+"""
+array backend of the rmsd path.
+
+Parsing and labeling build NumPy arrays internally, `asarray` hands them out as
+torch tensors (zero-copy) when the torch backend is selected, or as they are
+with the numpy backend. The other helpers dispatch on the type of their input,
+so the Kabsch and region rmsd code runs unchanged on either.
+
+The backend is chosen once, at import time, from `$AB_RMSD_BACKEND`
+("torch" or "numpy"). It defaults to torch when it is installed.
+With "numpy", torch is never imported.
+"""
+import os
+import numpy as np
+
+BACKEND = os.environ.get("AB_RMSD_BACKEND")
+if BACKEND is None:
+    try:
+        import torch
+        BACKEND = "torch"
+    except ImportError:
+        torch = None
+        BACKEND = "numpy"
+elif BACKEND == "torch":
+    import torch
+elif BACKEND == "numpy":
+    torch = None
+else:
+    raise ValueError(f'Unknown backend "{BACKEND}", expected "torch" or "numpy".')
+
+Tensor = torch.Tensor if torch is not None else np.ndarray
+
+
+def is_tensor(x):
+    return torch is not None and isinstance(x, torch.Tensor)
+
+
+def asarray(x):
+    """numpy array -> array of the selected backend, without copying."""
+    if BACKEND == "torch":
+        return torch.from_numpy(np.ascontiguousarray(x))
+    return x
+
+
+def to_numpy(x):
+    if is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def no_grad(fn):
+    """`torch.no_grad` with the torch backend, identity otherwise."""
+    if torch is not None:
+        return torch.no_grad()(fn)
+    return fn
+
+
+def sum(x, axis=None, keepdims=False):
+    if is_tensor(x):
+        if axis is None:
+            return x.sum()
+        return x.sum(dim=axis, keepdim=keepdims)
+    return np.sum(x, axis=axis, keepdims=keepdims)
+
+
+def mean(x, axis=None, keepdims=False):
+    if is_tensor(x):
+        if axis is None:
+            return x.mean()
+        return x.mean(dim=axis, keepdim=keepdims)
+    return np.mean(x, axis=axis, keepdims=keepdims)
+
+
+def any(x, axis):
+    if is_tensor(x):
+        return x.any(dim=axis)
+    return np.any(x, axis=axis)
+
+
+def sqrt(x):
+    return torch.sqrt(x) if is_tensor(x) else np.sqrt(x)
+
+
+def sign(x):
+    return torch.sign(x) if is_tensor(x) else np.sign(x)
+
+
+def det(x):
+    return torch.det(x) if is_tensor(x) else np.linalg.det(x)
+
+
+def svd(x):
+    """Returns U, S, Vt such that x = U diag(S) Vt."""
+    if is_tensor(x):
+        return torch.linalg.svd(x)
+    return np.linalg.svd(x)
+
+
+def broadcast_to(x, shape):
+    if is_tensor(x):
+        return x.expand(shape)
+    return np.broadcast_to(x, shape)
+
+
+def swapaxes(x):
+    """transpose the last two axes."""
+    if is_tensor(x):
+        return x.transpose(-1, -2)
+    return np.swapaxes(x, -1, -2)
+
+
+def stack(xs, axis=0):
+    if is_tensor(xs[0]):
+        return torch.stack(list(xs), dim=axis)
+    return np.stack(xs, axis=axis)
+
+
+def astype(x, like):
+    """cast `x` to the float dtype of `like`."""
+    if is_tensor(x):
+        return x.to(like.dtype)
+    return x.astype(like.dtype)
+
+
+def zeros(shape, like, dtype=None):
+    """zeros on the backend, device and (unless `dtype` is given) dtype of `like`."""
+    if is_tensor(like):
+        dtype = {bool: torch.bool, None: like.dtype}.get(dtype, dtype)
+        return torch.zeros(shape, dtype=dtype, device=like.device)
+    return np.zeros(shape, dtype=like.dtype if dtype is None else dtype)
+
+
+def ones(shape, like):
+    if is_tensor(like):
+        return torch.ones(shape, dtype=like.dtype, device=like.device)
+    return np.ones(shape, dtype=like.dtype)
+
+
+def zeros_like(x):
+    return torch.zeros_like(x) if is_tensor(x) else np.zeros_like(x)
+
+
+def bincount(x, minlength=0):
+    if is_tensor(x):
+        return torch.bincount(x, minlength=minlength)
+    return np.bincount(x, minlength=minlength)
+
+
+def segment_sum(values, index, n):
+    """out[..., i] = sum of `values[..., j]` with `index[j] == i`, for i in range(n)."""
+    if is_tensor(values):
+        return values.new_zeros(values.shape[:-1] + (n,)).index_add_(values.dim() - 1, index, values)
+    if values.ndim == 1:
+        return np.bincount(index, weights=values, minlength=n).astype(values.dtype)
+    out = np.zeros(values.shape[:-1] + (n,), dtype=values.dtype)
+    np.add.at(np.moveaxis(out, -1, 0), index, np.moveaxis(values, -1, 0))
+    return out
+
+
+def nbytes(x):
+    if is_tensor(x):
+        return x.element_size() * x.nelement()
+    return x.nbytes
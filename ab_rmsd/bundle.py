@@ -0,0 +1,165 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from ab_rmsd import backend
+
+MAGIC = b"ABRMSDBN"
+VERSION = 3
+# magic, version, index offset, index length
+_HEADER = struct.Struct("<8sIQQ")
+_ALIGN = 64
+
+
+def _encode(obj, arrays):
+    """json-able description of `obj`, its arrays are appended to `arrays` and referred to by position."""
+    if backend.is_tensor(obj) or isinstance(obj, np.ndarray):
+        arrays.append(backend.to_numpy(obj))
+        return {"array": len(arrays) - 1}
+    if isinstance(obj, dict):
+        if len(obj) > 0 and all(isinstance(k, tuple) for k in obj):
+            # seq map, (chain id, resseq, icode) -> residue index
+            keys = list(obj)
+            arrays.append(np.array([k[0] for k in keys], dtype=str))
+            arrays.append(np.array([k[1] for k in keys], dtype=np.int64))
+            arrays.append(np.array([k[2] for k in keys], dtype=str))
+            arrays.append(np.array(list(obj.values()), dtype=np.int64))
+            return {"seqmap": len(arrays) - 4}
+        return {"dict": {k: _encode(v, arrays) for k, v in obj.items()}}
+    if isinstance(obj, list) and len(obj) > 0 and all(isinstance(v, str) for v in obj):
+        arrays.append(np.array(obj, dtype=str))
+        return {"strs": len(arrays) - 1}
+    return {"value": obj}
+
+
+def _decode(node, arrays):
+    if "array" in node:
+        return backend.asarray(arrays[node["array"]])
+    if "seqmap" in node:
+        i = node["seqmap"]
+        keys = zip(arrays[i].tolist(), arrays[i + 1].tolist(), arrays[i + 2].tolist())
+        return dict(zip(keys, arrays[i + 3].tolist()))
+    if "dict" in node:
+        return {k: _decode(v, arrays) for k, v in node["dict"].items()}
+    if "strs" in node:
+        return arrays[node["strs"]].tolist()
+    return node["value"]
+
+
+def _encode_numberings(numberings):
+    return {
+        seq: [[list(n) if n is not None else None for n in numbers], chain_type]
+        for seq, (numbers, chain_type) in numberings.items()
+    }
+
+
+def _decode_numberings(numberings):
+    return {
+        seq: ([tuple(n) if n is not None else None for n in numbers], chain_type)
+        for seq, (numbers, chain_type) in numberings.items()
+    }
+
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % _ALIGN))
+
+
+def write_bundle(entries, out_path):
+    """
+    write parsed antibody dicts to a single bundle file, see `NativeBundle`.
+
+    Args:
+        entries (iterable): (name, pdb_path, ab_dict, numberings) of every structure,
+            `pdb_path` is stat'ed to detect files that changed after the bundle was written.
+        out_path (str):
+
+    Returns:
+        int: number of entries written.
+    """
+    index = {}
+    n_entries = 0
+    with open(out_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+        for name, pdb_path, ab_dict, numberings in entries:
+            arrays = []
+            tree = _encode(ab_dict, arrays)
+            array_refs = []
+            for array in arrays:
+                array = np.ascontiguousarray(array)
+                _pad(f)
+                array_refs.append([f.tell(), array.dtype.str, list(array.shape)])
+                f.write(array.tobytes())
+            meta = json.dumps(
+                {"tree": tree, "arrays": array_refs, "numberings": _encode_numberings(numberings)}
+            ).encode()
+            stat = os.stat(pdb_path)
+            index[name] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "meta": [f.tell(), len(meta)],
+            }
+            f.write(meta)
+            n_entries += 1
+        index_offset = f.tell()
+        index = json.dumps(index).encode()
+        f.write(index)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, index_offset, len(index)))
+    return n_entries
+
+
+class NativeBundle:
+    """
+    read-only, memory-mapped bundle of parsed antibody dicts written by `write_bundle`.
+
+    The file is a header, the arrays of every structure (64-byte aligned), a json
+    description per structure and a json index of names at the end. Opening a bundle
+    only reads the index, a structure is decoded when it is requested and its arrays
+    are views of the mapped file, so processes reading the same bundle share its pages.
+    The mapping is copy-on-write, arrays can be modified without changing the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="c")
+        magic, version, index_offset, index_length = _HEADER.unpack(
+            self._map[: _HEADER.size].tobytes()
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an ab_rmsd bundle.")
+        if version != VERSION:
+            raise ValueError(f"{path} has bundle version {version}, expected {VERSION}.")
+        self.index = json.loads(self._map[index_offset : index_offset + index_length].tobytes())
+
+    def _array(self, offset, dtype, shape):
+        dtype = np.dtype(dtype)
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        return self._map[offset : offset + nbytes].view(dtype).reshape(shape)
+
+    def load(self, name):
+        """
+        Returns:
+            tuple: antibody dict, chain numberings (see `parse_pdb`) of `name`.
+        """
+        offset, length = self.index[name]["meta"]
+        meta = json.loads(self._map[offset : offset + length].tobytes())
+        arrays = [self._array(*ref) for ref in meta["arrays"]]
+        return _decode(meta["tree"], arrays), _decode_numberings(meta["numberings"])
+
+    def get(self, pdb_path):
+        """`load` the entry of `pdb_path`, by file name, or None if it is missing or the file changed since."""
+        entry = self.index.get(os.path.basename(pdb_path))
+        if entry is None:
+            return None
+        stat = os.stat(pdb_path)
+        if (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return self.load(os.path.basename(pdb_path))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
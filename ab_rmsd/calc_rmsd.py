@@ -1,17 +1,52 @@
-from ab_rmsd.ab_number import renumber
-from ab_rmsd.read_pdb import preprocess_antibody_structure
+from ab_rmsd.ab_number import renumber_atoms
+from ab_rmsd.read_pdb import preprocess_antibody_atoms
+from ab_rmsd.utils.protein.pdb_reader import read_pdb_atoms
 from ab_rmsd.utils.utility import MergeChains, exists, exist_key,PDBParseError, save_pdb
-from .superimpose import KabschRMSD
-import torch
+from ab_rmsd.utils.protein.constants import (
+    CDRID2CDR,
+    CHAIN_CDRS,
+    CHAIN_FV_REGION,
+    CDR_SCHEMES,
+    NONCDRID,
+    REGION_SETS,
+    scheme_cdr_name,
+)
+from .superimpose import SUPERIMPOSE_ENGINES
+from .bundle import NativeBundle, write_bundle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from ab_rmsd import backend, timing
 
 
 
 class AntibodyRMSD:
     def __init__(
         self,
+        engine="kabsch",
+        region_sets=(),
+        cdr_schemes=(),
     ):
+        """
+        Args:
+            engine (str, optional): superimpose engine, "kabsch" (SVD) or "qcp". Defaults to "kabsch".
+            region_sets (tuple, optional): extra regions to score besides the CDRs and Fv,
+                names of `REGION_SETS` (e.g. "framework", "anchors") or dicts of the same form,
+                {chain: {region name: [(start resseq, end resseq), ...]}}. Defaults to ().
+            cdr_schemes (tuple, optional): also score the CDRs of these schemes of `CDR_SCHEMES`
+                ("kabat", "north", "imgt", "chothia"), as scheme-qualified regions
+                ("kabat:CDRH1", ...). Defaults to ().
+        """
         self.nb_atoms = 3  # num of atoms selected for superimpose
-        self.kabsch_rmsd = KabschRMSD()
+        self.kabsch_rmsd = SUPERIMPOSE_ENGINES[engine]()
+        self.region_sets = [
+            REGION_SETS[r] if isinstance(r, str) else r for r in region_sets
+        ]
+        for scheme in cdr_schemes:
+            if scheme not in CDR_SCHEMES:
+                raise ValueError(f'Unknown CDR scheme "{scheme}", expected one of {tuple(CDR_SCHEMES)}.')
+        self.cdr_schemes = tuple(cdr_schemes)
 
     def __call__(self, pred_antibody, native_antibody, superimpose_pred=False):
         """
@@ -48,53 +83,318 @@ class AntibodyRMSD:
                     f"native coordinate mismatches pred coordinate" 
                     f" {native_coord.shape} != {pred_coord.shape}"
                 )            
-            rot, trans = self.kabsch_rmsd.calc_superimpose_transformation(
-                native_coord.reshape(-1, 3) , pred_coord.reshape(-1, 3)
-            )
-            shape = pred_coord.shape
-            superimposed_pred_coord = self.kabsch_rmsd.apply_transformation(
-                rot, trans, pred_coord.reshape(-1, 3)
-            )
+            with timing.stage("superimpose"):
+                rot, trans = self.kabsch_rmsd.calc_superimpose_transformation(
+                    native_coord.reshape(-1, 3) , pred_coord.reshape(-1, 3)
+                )
+                shape = pred_coord.shape
+                superimposed_pred_coord = self.kabsch_rmsd.apply_transformation(
+                    rot, trans, pred_coord.reshape(-1, 3)
+                )
             superimposed_pred_coord = superimposed_pred_coord.reshape(*shape)
             
             rmsd = self._calc_region_rmsd(
-                native_antibody[chain]["select"], superimposed_pred_coord, native_coord
+                chain, native_antibody[chain], superimposed_pred_coord, native_coord
             )
             res.update(rmsd)
         return res
-            
-        
-
-    def _calc_region_rmsd(self, select_mask_dict, pred_coord, native_coord):
-        res_dict = {}
-        for region_id, region_mask in select_mask_dict.items():
-            pred_region_coord = pred_coord[region_mask].reshape(-1, 3)
-            native_region_coord = native_coord[region_mask].reshape(-1, 3)
-            rmsd = self.kabsch_rmsd(pred_region_coord, native_region_coord,superimpose=False)
-            res_dict[region_id] = rmsd
+
+    def ensemble(self, pred_antibody, native_antibody):
+        """
+        calculate the rmsd of every model of a predicted ensemble to the native antibody,
+        each chain of all models is superimposed in one batch.
+
+        Args:
+            pred_antibody (dict): parsed with `all_models=True`, see `parse_pdb`.
+            native_antibody (dict):
+
+        Returns:
+            dict: rmsd (M,) of each region over the M models.
+        """
+        res = {}
+        for chain in ("heavy", "light"):
+            if not (exist_key(pred_antibody, chain) and exist_key(native_antibody, chain)):
+                continue
+            native_coord = native_antibody[chain]["pos_heavyatom"][..., : self.nb_atoms, :]
+            pred_coord = pred_antibody[chain]["pos_heavyatom_models"][..., : self.nb_atoms, :]
+            if native_coord.shape != pred_coord.shape[1:]:
+                raise ValueError(
+                    f"native coordinate mismatches pred coordinate"
+                    f" {native_coord.shape} != {pred_coord.shape[1:]}"
+                )
+            n_models = pred_coord.shape[0]
+            pred_flat = pred_coord.reshape(n_models, -1, 3)
+            native_flat = backend.broadcast_to(native_coord.reshape(1, -1, 3), pred_flat.shape)
+            with timing.stage("superimpose"):
+                rot, trans = self.kabsch_rmsd.batch_calc_superimpose_transformation(
+                    native_flat, pred_flat
+                )
+                superimposed_pred_coord = self.kabsch_rmsd.batch_apply_transformation(
+                    rot, trans, pred_flat
+                ).reshape(pred_coord.shape)
+            res.update(
+                self._calc_region_rmsd(
+                    chain, native_antibody[chain], superimposed_pred_coord, native_coord
+                )
+            )
+        return res
+
+    @timing.timed("region_rmsd")
+    def _calc_region_rmsd(self, chain, native_chain, pred_coord, native_coord):
+        """
+        rmsd of every region of a chain from a single squared deviation tensor.
+        CDRs and Fv partition the chain by `cdr_flag` and are reduced with one segment sum,
+        extra (possibly overlapping) regions and the CDRs of `cdr_schemes` are reduced with one
+        mask product.
+        `pred_coord` may have a leading model axis, the rmsds then have it too.
+        """
+        # squared deviation summed over the atoms of each residue, (L,) or (M, L)
+        res_sq = backend.sum(backend.sum((pred_coord - native_coord) ** 2, axis=-1), axis=-1)
+        cdr_flag = native_chain["cdr_flag"]
+        nb_regions = max(CDRID2CDR) + 1
+        sq_sum = backend.segment_sum(res_sq, cdr_flag, nb_regions)
+        count = backend.astype(backend.bincount(cdr_flag, minlength=nb_regions), res_sq) * self.nb_atoms
+        rmsd = backend.sqrt(sq_sum / _nan_if_empty(count))
+
+        res_dict = {CDRID2CDR[flag]: rmsd[..., flag] for flag in CHAIN_CDRS[chain]}
+        res_dict[CHAIN_FV_REGION[chain]] = rmsd[..., NONCDRID]
+
+        regions = {}
+        for region_set in self.region_sets:
+            regions.update(region_set.get(chain, {}))
+        resseq = native_chain["resseq"]
+        masks = {
+            name: backend.any(backend.stack([(resseq >= start) & (resseq <= end) for start, end in ranges]), axis=0)
+            for name, ranges in regions.items()
+        }
+        # CDRs of the other schemes, labeled from the same numbering when the native was parsed.
+        for scheme in self.cdr_schemes:
+            for cdr in CHAIN_CDRS[chain]:
+                name = scheme_cdr_name(scheme, cdr)
+                masks[name] = native_chain["select"][name]
+        if len(masks) > 0:
+            mask = backend.astype(backend.stack(list(masks.values())), res_sq)  # (R, L)
+            rmsd = backend.sqrt(
+                (res_sq @ backend.swapaxes(mask)) / _nan_if_empty(backend.sum(mask, axis=-1) * self.nb_atoms)
+            )
+            res_dict.update({name: rmsd[..., i] for i, name in enumerate(masks)})
         return res_dict
 
-def calc_ab_rmsd(pred_path, native_path):
+
+def _nan_if_empty(count):
+    """atom counts with the empty regions (the region ids of other chains) set to nan,
+    so their rmsd is nan, as the mean over no atoms was, without a division by zero."""
+    count[count == 0] = float("nan")
+    return count
+
+def _nbytes(obj):
+    """approximate memory footprint of the tensors held in a (nested) antibody dict."""
+    if backend.is_tensor(obj) or isinstance(obj, np.ndarray):
+        return backend.nbytes(obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return 0
+
+
+class NativeCache:
+    """
+    LRU cache of parsed native antibody dicts, keyed by (path, size, mtime),
+    so a native scored against several predictions is only parsed once.
+    A file that changes on disk gets a new key and is parsed again.
+    Natives found in a loaded `NativeBundle` (see `precompute`) are not parsed at all.
+
+    The cached dicts are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 ** 2, bundle_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bundle_hits = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self.bundle = None
+        if bundle_path:
+            self.load_bundle(bundle_path)
+
+    def load_bundle(self, bundle_path):
+        self.bundle = NativeBundle(bundle_path)
+
+    @staticmethod
+    def _key(pdb_path):
+        stat = os.stat(pdb_path)
+        return (os.path.abspath(pdb_path), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, pdb_path, numberings=None):
+        """
+        Args:
+            pdb_path (str):
+            numberings (dict, optional): filled with the chain numberings of the native,
+                see `parse_pdb`. Defaults to None.
+        """
+        key = self._key(pdb_path)
+        if key in self._entries:
+            self.hits += 1
+            timing.count("native_cache_hit")
+            self._entries.move_to_end(key)
+            ab_dict, native_numberings, _ = self._entries[key]
+        else:
+            bundled = self.bundle.get(pdb_path) if self.bundle is not None else None
+            if bundled is not None:
+                # views of the mapped bundle, not worth keeping in the LRU
+                self.bundle_hits += 1
+                timing.count("native_bundle_hit")
+                ab_dict, native_numberings = bundled
+            else:
+                self.misses += 1
+                native_numberings = {}
+                ab_dict = parse_pdb(pdb_path, native_numberings)
+                self._put(key, ab_dict, native_numberings)
+        if numberings is not None:
+            numberings.update(native_numberings)
+        return ab_dict
+
+    def _put(self, key, ab_dict, numberings):
+        size = _nbytes(ab_dict)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (ab_dict, numberings, size)
+        self.nbytes += size
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_size
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bundle_hits": self.bundle_hits,
+            "entries": len(self._entries),
+            "nbytes": self.nbytes,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+native_cache = NativeCache(bundle_path=os.environ.get("AB_RMSD_NATIVE_BUNDLE"))
+
+
+def _parse_native(pdb_path):
+    numberings = {}
+    try:
+        return pdb_path, parse_pdb(pdb_path, numberings), numberings, None
+    except Exception as e:
+        return pdb_path, None, numberings, str(e)
+
+
+def precompute(native_dir, out_path, workers=1):
+    """
+    parse every structure of `native_dir` into a single bundle at `out_path`,
+    loaded with `native_cache.load_bundle` or `$AB_RMSD_NATIVE_BUNDLE`.
+    structures that fail to parse are left out, and parsed again when they are scored.
+
+    Returns:
+        int: number of structures in the bundle.
+    """
+    paths = [os.path.join(native_dir, f) for f in sorted(os.listdir(native_dir))]
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_parse_native, paths, chunksize=8)
+    else:
+        executor = None
+        results = map(_parse_native, paths)
+
+    def entries():
+        for pdb_path, ab_dict, numberings, error in results:
+            if ab_dict is None:
+                print(f"[INFO] {pdb_path} left out of the bundle: {error}")
+                continue
+            yield os.path.basename(pdb_path), pdb_path, ab_dict, numberings
+
+    try:
+        return write_bundle(entries(), out_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def calc_ab_rmsd(pred_path, native_path, cache_native=False, engine="kabsch", region_sets=(), cdr_schemes=()):
     """
     calculate the rmsd between two antibodys.
 
     Args:
         pred_path (str): 
         native_path (str): 
+        cache_native (bool, optional): reuse the parsed native from `native_cache`. Defaults to False.
+        engine (str, optional): superimpose engine, "kabsch" or "qcp". Defaults to "kabsch".
+        region_sets (tuple, optional): extra regions to score, see `AntibodyRMSD`. Defaults to ().
+        cdr_schemes (tuple, optional): also score the CDRs of these schemes, see `AntibodyRMSD`. Defaults to ().
     """
-    pred_ab = parse_pdb(pred_path)
-    native_ab = parse_pdb(native_path)
-    rmsd = AntibodyRMSD()(pred_ab,native_ab)
+    pred_ab, native_ab = parse_pdb_pair(pred_path, native_path, cache_native)
+    rmsd = AntibodyRMSD(engine, region_sets, cdr_schemes)(pred_ab,native_ab)
     rmsd = {k:v.item() for k, v in rmsd.items()}
     return rmsd
 
-def parse_pdb(pdb_path):
+def calc_ab_rmsd_ensemble(pred_path, native_path, cache_native=False, engine="kabsch", region_sets=(), cdr_schemes=()):
+    """
+    calculate the rmsd of every model of a multi-model predicted file (MD snapshots, samples, ...)
+    to the native antibody. the predicted file is numbered and labeled once, from its first model.
+
+    Args:
+        see `calc_ab_rmsd`.
+
+    Returns:
+        list: rmsd dict of each model, in file order.
+    """
+    pred_ab, native_ab = parse_pdb_pair(pred_path, native_path, cache_native, all_models=True)
+    rmsd = AntibodyRMSD(engine, region_sets, cdr_schemes).ensemble(pred_ab, native_ab)
+    rmsd = {k: backend.to_numpy(v).tolist() for k, v in rmsd.items()}
+    n_models = len(next(iter(rmsd.values()), []))
+    return [{k: v[i] for k, v in rmsd.items()} for i in range(n_models)]
+
+def parse_pdb_pair(pred_path, native_path, cache_native=False, all_models=False):
+    """
+    parse a predicted and a native pdb file.
+    the native is numbered first, predicted chains with the same sequence as a
+    native chain reuse its numbering, only the other chains are sent to ANARCI.
+
+    Args:
+        pred_path (str): 
+        native_path (str): 
+        cache_native (bool, optional): reuse the parsed native from `native_cache`. Defaults to False.
+        all_models (bool, optional): parse every model of the predicted file, see `parse_pdb`. Defaults to False.
+
+    Returns:
+        tuple: predicted antibody dict, native antibody dict
+    """
+    numberings = {}
+    if cache_native:
+        native_ab = native_cache.get(native_path, numberings)
+    else:
+        native_ab = parse_pdb(native_path, numberings)
+    pred_ab = parse_pdb(pred_path, numberings, all_models)
+    return pred_ab, native_ab
+
+def parse_pdb(pdb_path, numberings=None, all_models=False):
     """
     parse a pdb file to protein dict.
     the pdb file must contain at least the heavy chain.
+    .pdb, .cif and their gzip compressed versions are read, see `open_structure`.
     
     Args:
         pdb_path (str): 
+        numberings (dict, optional): chain sequence -> numbering, see `renumber`. Defaults to None.
+        all_models (bool, optional): also pack the coordinates of every model into
+            `pos_heavyatom_models` (M, L, atoms, 3) of each chain. all models must have the
+            atoms of the first one, which alone is numbered. Defaults to False.
 
     Raises:
         ValueError: No heavy chain found in pdb file.
@@ -102,11 +402,13 @@ def parse_pdb(pdb_path):
     Returns:
         dict: dict of heavy and light chain info.
     """
-    model, heavy_chains, light_chains, other_chains = renumber(pdb_path)
+    atoms, heavy_chains, light_chains, other_chains = renumber_atoms(
+        read_pdb_atoms(pdb_path, all_models), numberings
+    )
     if len(heavy_chains) == 0: raise PDBParseError("No heavy chain found in pdb file, path: {}".format(pdb_path))
     h_id = heavy_chains[0]
     l_id = light_chains[0] if len(light_chains) != 0 else None
-    ab_dict = preprocess_antibody_structure(
-        model, h_id, l_id
+    ab_dict = preprocess_antibody_atoms(
+        atoms, h_id, l_id
     )
     return ab_dict
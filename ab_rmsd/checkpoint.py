@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+def hash_inputs(*paths, tag=""):
+    """sha256 over `tag` and the content of every file in `paths`."""
+    h = hashlib.sha256(tag.encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def _json_default(obj):
+    # numpy / torch scalars, e.g. the float32 scores of DockQ
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+class Manifest:
+    """
+    append-only json-lines checkpoint of completed items.
+
+    every line records an item id, the hash of its inputs and its result.
+    a run that is restarted can look up ids whose inputs did not change and
+    reuse their results instead of recomputing them.
+    a truncated last line (the run was killed while writing) is ignored.
+    """
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            self._load()
+            self._compact()
+            self._f = open(path, "a")
+        else:
+            self._f = open(path, "w")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[entry["id"]] = (entry["hash"], entry["result"])
+
+    def _compact(self):
+        """
+        rewrite the manifest without stale duplicates and partial lines. the entries are
+        written to a temporary file next to it that then replaces it, so a run killed
+        meanwhile still finds the old manifest.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".", dir=os.path.dirname(os.path.abspath(self.path))
+        )
+        try:
+            with os.fdopen(fd, "w") as self._f:
+                for id, (digest, result) in self.entries.items():
+                    self._append(id, digest, result)
+                os.fsync(self._f.fileno())
+            shutil.copymode(self.path, tmp_path)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, id, digest):
+        """result of `id` if it was completed with the same input hash, else None."""
+        entry = self.entries.get(id)
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+        return None
+
+    def add(self, id, digest, result):
+        self.entries[id] = (digest, result)
+        self._append(id, digest, result)
+
+    def _append(self, id, digest, result):
+        self._f.write(
+            json.dumps({"id": id, "hash": digest, "result": result}, default=_json_default) + "\n"
+        )
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
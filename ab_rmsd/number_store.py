@@ -0,0 +1,178 @@
+import atexit
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def default_cache_dir():
+    """`$AB_RMSD_CACHE_DIR`, or `ab_rmsd` under `$XDG_CACHE_HOME` (defaults to ~/.cache)."""
+    if os.environ.get("AB_RMSD_CACHE_DIR"):
+        return os.environ["AB_RMSD_CACHE_DIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "ab_rmsd")
+
+
+# bump when the format of the stored numberings changes.
+SCHEMA_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def numbering_version():
+    """store schema and installed abnumber / ANARCI versions, numberings of other versions are not reused."""
+    from importlib.metadata import PackageNotFoundError, version
+
+    versions = [str(SCHEMA_VERSION)]
+    for package in ("abnumber", "anarci"):
+        try:
+            versions.append(version(package))
+        except PackageNotFoundError:
+            versions.append("")
+    return "/".join(versions)
+
+
+def sequence_key(seq, scheme):
+    return hashlib.sha256(f"{numbering_version()}:{scheme}:{seq}".encode()).hexdigest()
+
+
+class NumberStore:
+    """
+    persistent, content-addressed store of ANARCI numberings.
+
+    Maps (sequence hash, scheme) to the per-residue numbering and chain type
+    returned by `abnumber`, so a sequence is only aligned once across runs.
+    The hash also covers `numbering_version`, after an abnumber / ANARCI upgrade
+    sequences are aligned again and the old rows age out through the LRU eviction.
+    Sequences that failed to number are stored too, with their error message.
+    When the store grows past `max_entries`, the least recently used rows are evicted,
+    down to 1% below `max_entries`. The rows are only counted when an in-memory upper
+    bound of the count passes `max_entries`, not on every `put`.
+    The access times of hits are kept in memory and written in one transaction every
+    `touch_batch` hits, before a `put` and at exit, instead of one commit per hit.
+    """
+
+    def __init__(self, path=None, max_entries=200000, touch_batch=256):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "numbering.sqlite")
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self._touched = {}  # key -> access time not yet written
+        self._count = None  # upper bound of the number of rows
+        self._conn = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def _connect(self):
+        # sqlite connections must not be shared with forked worker processes.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS numbering ("
+                " key TEXT PRIMARY KEY,"
+                " scheme TEXT NOT NULL,"
+                " chain_type TEXT,"
+                " numbers TEXT,"
+                " error TEXT,"
+                " accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS numbering_accessed ON numbering (accessed)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+            # hits recorded by the parent process are the parent's to write.
+            self._touched = {}
+            self._count = None
+        return self._conn
+
+    def get(self, seq, scheme="chothia"):
+        """
+        Returns:
+            tuple or None: (numbers, chain_type, error) or None if `seq` is not in the store.
+        """
+        key = sequence_key(seq, scheme)
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT chain_type, numbers, error FROM numbering WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._touched[key] = time.time()
+        if len(self._touched) >= self.touch_batch:
+            self.flush()
+        chain_type, numbers, error = row
+        if numbers is not None:
+            numbers = [None if n is None else (n[0], n[1]) for n in json.loads(numbers)]
+        return numbers, chain_type, error
+
+    def put(self, seq, numbers=None, chain_type=None, error=None, scheme="chothia"):
+        key = sequence_key(seq, scheme)
+        conn = self._connect()
+        self._write_touched(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO numbering VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                scheme,
+                chain_type,
+                None if numbers is None else json.dumps(numbers),
+                error,
+                time.time(),
+            ),
+        )
+        self._evict(conn)
+        conn.commit()
+
+    def flush(self):
+        """write the access times of the hits since the last flush."""
+        if self._touched and self._pid == os.getpid():
+            conn = self._connect()
+            self._write_touched(conn)
+            conn.commit()
+
+    def _write_touched(self, conn):
+        conn.executemany(
+            "UPDATE numbering SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._touched.items()],
+        )
+        self._touched = {}
+
+    def _evict(self, conn):
+        # every put counts as a new row, replaced rows and other processes' rows are
+        # caught up with by the real count once the bound passes `max_entries`.
+        if self._count is not None:
+            self._count += 1
+            if self._count <= self.max_entries:
+                return
+        (count,) = conn.execute("SELECT COUNT(*) FROM numbering").fetchone()
+        if count > self.max_entries:
+            n_evict = count - self.max_entries + self.max_entries // 100
+            conn.execute(
+                "DELETE FROM numbering WHERE key IN ("
+                " SELECT key FROM numbering ORDER BY accessed ASC LIMIT ?)",
+                (n_evict,),
+            )
+            count -= n_evict
+        self._count = count
+
+    def clear(self):
+        conn = self._connect()
+        self._touched = {}
+        self._count = 0
+        conn.execute("DELETE FROM numbering")
+        conn.commit()
+
+    def __len__(self):
+        (count,) = self._connect().execute("SELECT COUNT(*) FROM numbering").fetchone()
+        return count
+
+
+# set `AB_RMSD_NUMBER_CACHE=0` to always call ANARCI.
+number_store = (
+    NumberStore() if os.environ.get("AB_RMSD_NUMBER_CACHE", "1") != "0" else None
+)
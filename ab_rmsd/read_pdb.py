@@ -1,8 +1,18 @@
 import logging
+import numpy as np
 from Bio.PDB import PDBExceptions, Model
+from ab_rmsd import backend
 from ab_rmsd.utils.label_chain import _label_heavy_chain_cdr, _label_light_chain_cdr
 from ab_rmsd.utils.protein import parsers
-from ab_rmsd.utils.protein.constants import CDR, CDRID2CDR, NONCDRID
+from ab_rmsd.utils.protein.pdb_reader import chain_ids_in_order
+from ab_rmsd.utils.protein.constants import (
+    CDR,
+    CDR_SCHEME_TABLES,
+    CDRID2CDR,
+    CHAIN_CDRS,
+    NONCDRID,
+    scheme_cdr_name,
+)
 
 
 def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
@@ -23,6 +33,43 @@ def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
 
     all_chain_ids = [c.id for c in model]
 
+    def parse_chains(chain_ids, max_resseq=None):
+        return parsers.parse_biopython_structure(
+            [model[c] for c in chain_ids], max_resseq=max_resseq
+        )
+
+    return _preprocess(parse_chains, all_chain_ids, H_id, L_id, id)
+
+
+def preprocess_antibody_atoms(atoms, H_id, L_id, id=None):
+    """
+    same as `preprocess_antibody_structure`, from the per-atom arrays of `pdb_reader.read_pdb_atoms`.
+    """
+    all_chain_ids = chain_ids_in_order(atoms)
+
+    def parse_chains(chain_ids, max_resseq=None):
+        return parsers.parse_atom_array(atoms, chain_ids, max_resseq=max_resseq)
+
+    return _preprocess(parse_chains, all_chain_ids, H_id, L_id, id)
+
+
+def _scheme_select(chain_data, chain):
+    """
+    scheme-qualified CDR masks of a chain ("kabat:CDRH1", ...) for every scheme of `CDR_SCHEME_TABLES`,
+    looked up from its Chothia resseq.
+    """
+    resseq = backend.to_numpy(chain_data["resseq"])
+    select = {}
+    for scheme, tables in CDR_SCHEME_TABLES.items():
+        table = tables[chain]
+        flag = table[np.clip(resseq, 0, len(table) - 1)]
+        for cdr in CHAIN_CDRS[chain]:
+            select[scheme_cdr_name(scheme, cdr)] = backend.asarray(flag == cdr)
+    return select
+
+
+def _preprocess(parse_chains, all_chain_ids, H_id, L_id, id=None):
+
     parsed = {
         "id": id,
         "heavy": None,
@@ -35,8 +82,8 @@ def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
     try:
         if H_id in all_chain_ids:
             (parsed["heavy"], parsed["heavy_seqmap"]) = _label_heavy_chain_cdr(
-                *parsers.parse_biopython_structure(
-                    model[H_id], max_resseq=113  # Chothia, end of Heavy chain Fv
+                *parse_chains(
+                    [H_id], max_resseq=113  # Chothia, end of Heavy chain Fv
                 )
             )
             parsed["heavy"]["select"] = {
@@ -46,11 +93,12 @@ def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
             parsed["heavy"]["select"].update(
                 {"fv-H": (parsed["heavy"]["cdr_flag"] == NONCDRID)}
             )
+            parsed["heavy"]["select"].update(_scheme_select(parsed["heavy"], "heavy"))
 
         if L_id in all_chain_ids:
             (parsed["light"], parsed["light_seqmap"]) = _label_light_chain_cdr(
-                *parsers.parse_biopython_structure(
-                    model[L_id], max_resseq=106  # Chothia, end of Light chain Fv
+                *parse_chains(
+                    [L_id], max_resseq=106  # Chothia, end of Light chain Fv
                 )
             )
 
@@ -61,6 +109,7 @@ def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
             parsed["light"]["select"].update(
                 {"fv-L": (parsed["light"]["cdr_flag"] == NONCDRID)}
             )
+            parsed["light"]["select"].update(_scheme_select(parsed["light"], "light"))
 
         if parsed["heavy"] is None and parsed["light"] is None:
             raise ValueError(
@@ -71,11 +120,10 @@ def preprocess_antibody_structure(model:Model, H_id, L_id, id=None):
 
         ag_chain_ids = [cid for cid in all_chain_ids if cid not in (H_id, L_id)]
         if len(ag_chain_ids) > 0:
-            chains = [model[c] for c in ag_chain_ids]
             (
                 parsed["antigen"],
                 parsed["antigen_seqmap"],
-            ) = parsers.parse_biopython_structure(chains)
+            ) = parse_chains(ag_chain_ids)
 
     except (
         PDBExceptions.PDBConstructionException,
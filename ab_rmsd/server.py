@@ -0,0 +1,228 @@
+"""
+long-lived scoring server, keeps the package imported and the numbering / native caches
+of its worker processes warm between requests.
+
+requests and responses are json lines, over a unix domain socket or stdin / stdout:
+
+    {"id": 1, "mode": "rmsd", "pred": "pred.pdb", "native": "native.pdb"}
+    {"id": 1, "result": {"CDRH1": 0.47, ...}}
+
+structures can be sent inline as "pred_pdb" / "native_pdb" text instead of paths.
+"mode" is "rmsd" (default, `calc_ab_rmsd`), "ensemble" (`calc_ab_rmsd_ensemble`) or
+"dockq" (`calc_DockQ`), "engine", "region_sets" and "cdr_schemes" are passed to the rmsd modes.
+a request that fails is answered with {"id": ..., "error": "..."}, also when its worker
+process died, the pool of workers is then replaced.
+
+    python -m ab_rmsd.server --socket /tmp/ab_rmsd.sock --workers 4
+    python -m ab_rmsd.server --stdin < requests.jsonl > responses.jsonl
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from ab_rmsd.checkpoint import _json_default
+
+MODES = ("rmsd", "ensemble", "dockq")
+
+
+def _init_worker():
+    # stdout carries the responses in --stdin mode, progress messages go to stderr.
+    sys.stdout = sys.stderr
+    from ab_rmsd import calc_rmsd  # noqa: F401, imported once per worker
+
+
+def _input_path(request, key, tmp_dir):
+    """path of the "pred" / "native" structure of `request`, inline text is written to `tmp_dir`."""
+    if key + "_pdb" in request:
+        path = os.path.join(tmp_dir, key + ".pdb")
+        with open(path, "w") as f:
+            f.write(request[key + "_pdb"])
+        return path
+    return request[key]
+
+
+def score(request):
+    """
+    score a single request, in a worker process.
+
+    Returns:
+        dict: {"id", "result"} or {"id", "error"}.
+    """
+    id = request.get("id")
+    try:
+        mode = request.get("mode", "rmsd")
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode "{mode}", expected one of {MODES}.')
+        with tempfile.TemporaryDirectory(prefix="ab_rmsd_") as tmp_dir:
+            pred = _input_path(request, "pred", tmp_dir)
+            native = _input_path(request, "native", tmp_dir)
+            if mode == "dockq":
+                from ab_rmsd.DockQ.DockQ import calc_DockQ
+
+                result = calc_DockQ(pred, native)
+            else:
+                from ab_rmsd.calc_rmsd import calc_ab_rmsd, calc_ab_rmsd_ensemble
+
+                calc_fn = calc_ab_rmsd_ensemble if mode == "ensemble" else calc_ab_rmsd
+                result = calc_fn(
+                    pred,
+                    native,
+                    # inline natives live in a temporary directory, there is nothing to reuse.
+                    cache_native="native_pdb" not in request,
+                    engine=request.get("engine", "kabsch"),
+                    region_sets=tuple(request.get("region_sets", ())),
+                    cdr_schemes=tuple(request.get("cdr_schemes", ())),
+                )
+        return {"id": id, "result": result}
+    except Exception as e:
+        return {"id": id, "error": f"{e.__class__.__name__}: {e}"}
+
+
+def _dumps(response):
+    return json.dumps(response, default=_json_default)
+
+
+class ScoringServer:
+    """
+    answers json-line requests (see the module docstring) with a pool of `workers` processes,
+    which bounds the number of structures scored at the same time.
+    a pool that broke (a worker was killed, e.g. out of memory) is replaced by a new one.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._pool_lock = threading.Lock()
+        self.executor = self._new_pool()
+        # start the workers now, the first requests should not pay for the imports.
+        wait([self.executor.submit(int) for _ in range(workers)])
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def _replace_pool(self, broken):
+        with self._pool_lock:
+            if self.executor is broken:
+                print("[WARN] the worker pool broke, starting a new one.", file=sys.stderr)
+                self.executor = self._new_pool()
+        broken.shutdown(wait=False)
+
+    def submit(self, line):
+        """future of the response to the request `line`, it never raises."""
+        response = Future()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request must be a json object.")
+        except ValueError as e:
+            response.set_result({"id": None, "error": f"{e.__class__.__name__}: {e}"})
+            return response
+        executor = self.executor
+        try:
+            scored = executor.submit(score, request)
+        except BrokenProcessPool:
+            self._replace_pool(executor)
+            executor = self.executor
+            scored = executor.submit(score, request)
+
+        def done(scored):
+            try:
+                response.set_result(scored.result())
+            except Exception as e:  # `score` catches its own errors, this is the pool failing
+                if isinstance(e, BrokenProcessPool):
+                    self._replace_pool(executor)
+                response.set_result({"id": request.get("id"), "error": f"{e.__class__.__name__}: {e}"})
+
+        scored.add_done_callback(done)
+        return response
+
+    def serve_stdin(self, stdin=sys.stdin, stdout=sys.stdout):
+        """
+        answer the requests read from `stdin` until it is closed.
+        requests are pipelined, responses are written as they complete and may be out of order.
+        """
+        lock = threading.Lock()
+
+        def respond(future):
+            with lock:
+                stdout.write(_dumps(future.result()) + "\n")
+                stdout.flush()
+
+        futures = []
+        for line in stdin:
+            if line.strip():
+                future = self.submit(line)
+                future.add_done_callback(respond)
+                futures.append(future)
+        wait(futures)
+
+    def serve_socket(self, socket_path):
+        """answer requests on the unix domain socket `socket_path`, one thread per connection."""
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        response = server.submit(line).result()
+                        self.wfile.write((_dumps(response) + "\n").encode())
+                        self.wfile.flush()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as unix_server:
+            unix_server.daemon_threads = True
+            print(f"[INFO] listening on {socket_path} with {self.workers} workers.", file=sys.stderr)
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(socket_path)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def request(socket_path, **request):
+    """send one request to the server listening on `socket_path` and return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile("rwb") as f:
+            f.write((_dumps(request) + "\n").encode())
+            f.flush()
+            return json.loads(f.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="long-lived antibody rmsd / DockQ scoring server.")
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument("--socket", type=str, help="unix domain socket to listen on.")
+    transport.add_argument("--stdin", action="store_true", help="read requests from stdin, answer on stdout.")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes.")
+    args = parser.parse_args()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # service managers stop the server with SIGTERM, shut down as on ctrl-c.
+    signal.signal(signal.SIGTERM, stop)
+    server = ScoringServer(args.workers)
+    try:
+        if args.stdin:
+            server.serve_stdin()
+        else:
+            server.serve_socket(args.socket)
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
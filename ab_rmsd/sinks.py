@@ -0,0 +1,240 @@
+import csv
+import json
+import math
+import numbers
+import os
+
+from ab_rmsd.checkpoint import _json_default
+
+
+class RunningMean:
+    """
+    running sum and count of every numeric column, used to build the `mean` row.
+    non-finite values (e.g. NaN of a missing region) are skipped like `DataFrame.mean` does,
+    and counted per column in `non_finite`.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+        self.non_finite = {}
+
+    def update(self, result):
+        for k, v in result.items():
+            if isinstance(v, bool) or not isinstance(v, numbers.Real):
+                continue
+            v = float(v)
+            if not math.isfinite(v):
+                self.non_finite[k] = self.non_finite.get(k, 0) + 1
+                continue
+            self.sums[k] = self.sums.get(k, 0.0) + v
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    def mean(self):
+        keys = list(self.sums) + [k for k in self.non_finite if k not in self.sums]
+        return {k: self.sums[k] / self.counts[k] if k in self.sums else float("nan") for k in keys}
+
+
+class ResultSink:
+    """
+    append-only writer of per-item results.
+    every result is written as soon as it is added, the file is flushed every
+    `flush_every` results and a `mean` row is appended on `close`.
+    """
+
+    index_label = "id"
+
+    def __init__(self, out_path, flush_every=100):
+        self.out_path = out_path
+        self.flush_every = max(1, flush_every)
+        self.columns = []
+        self.running_mean = RunningMean()
+        self.n_written = 0
+        self._n_unflushed = 0
+
+    def write(self, id, result):
+        for k in result:
+            if k not in self.columns:
+                self.columns.append(k)
+        self.running_mean.update(result)
+        self._write_row(id, result)
+        self.n_written += 1
+        self._n_unflushed += 1
+        if self._n_unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._n_unflushed = 0
+
+    def close(self):
+        mean = self.running_mean.mean()
+        if self.n_written > 0:
+            self._write_row("mean", mean)
+        self.flush()
+        return mean
+
+    def _write_row(self, id, result):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep what has been written so far, but do not add a mean row.
+            self.flush()
+
+
+class CSVSink(ResultSink):
+    """
+    csv writer. the header is taken from the first result. columns are only
+    ever appended, so rows written after a new column shows up stay aligned,
+    and the file is rewritten once with the full header on `close`.
+    """
+
+    def __init__(self, out_path, flush_every=100, float_format="%.3f"):
+        super().__init__(out_path, flush_every)
+        self.float_format = float_format
+        self._header = None
+        self._f = open(out_path, "w", newline="")
+        self._writer = csv.writer(self._f)
+
+    def _format(self, v):
+        if isinstance(v, numbers.Real) and not isinstance(v, numbers.Integral):  # float, np.float32, ...
+            return self.float_format % v
+        return "" if v is None else v
+
+    def _write_row(self, id, result):
+        if self._header is None:
+            self._header = list(self.columns)
+            self._writer.writerow([self.index_label] + self._header)
+        self._writer.writerow([id] + [self._format(result.get(k)) for k in self.columns])
+
+    def flush(self):
+        super().flush()
+        self._f.flush()
+
+    def close(self):
+        mean = super().close()
+        self._f.close()
+        if self._header is not None and len(self._header) != len(self.columns):
+            self._rewrite_header()
+        return mean
+
+    def _rewrite_header(self):
+        with open(self.out_path, newline="") as f:
+            rows = list(csv.reader(f))
+        with open(self.out_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([self.index_label] + self.columns)
+            for row in rows[1:]:
+                writer.writerow(row + [""] * (len(self.columns) + 1 - len(row)))
+
+
+class JSONLSink(ResultSink):
+    """json-lines writer, one object per result."""
+
+    def __init__(self, out_path, flush_every=100):
+        super().__init__(out_path, flush_every)
+        self._f = open(out_path, "w")
+
+    def _write_row(self, id, result):
+        self._f.write(json.dumps({self.index_label: id, **result}, default=_json_default) + "\n")
+
+    def flush(self):
+        super().flush()
+        self._f.flush()
+
+    def close(self):
+        mean = super().close()
+        self._f.close()
+        return mean
+
+
+class ParquetSink(ResultSink):
+    """
+    parquet writer, requires `pyarrow`. results are buffered and every flush
+    writes them to a part file next to `out_path`. on `close` the parts are merged
+    into `out_path` under the union of their schemas, so columns that only show
+    up in later results are kept, with nulls in the rows written before.
+    """
+
+    def __init__(self, out_path, flush_every=1000):
+        super().__init__(out_path, flush_every)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("writing parquet requires `pyarrow`, please install it.") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._rows = []
+        self._parts = []
+
+    def _write_row(self, id, result):
+        self._rows.append({self.index_label: id, **result})
+
+    def flush(self):
+        super().flush()
+        if len(self._rows) == 0:
+            return
+        names = [self.index_label] + self.columns
+        table = self._pa.Table.from_pylist(
+            [{k: row.get(k) for k in names} for row in self._rows]
+        )
+        part = f"{self.out_path}.part{len(self._parts)}"
+        self._pq.write_table(table, part)
+        self._parts.append(part)
+        self._rows = []
+
+    def close(self):
+        mean = super().close()
+        self._merge_parts()
+        return mean
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if exc_type is not None:
+            self._merge_parts()
+
+    def _merge_parts(self):
+        if len(self._parts) == 0:
+            return
+        schemas = [self._pq.read_schema(part) for part in self._parts]
+        try:
+            # int and float columns (e.g. a count and its mean) unify to float.
+            unified = self._pa.unify_schemas(schemas, promote_options="permissive")
+        except TypeError:  # pyarrow < 14
+            unified = self._pa.unify_schemas(schemas)
+        names = [self.index_label] + self.columns
+        schema = self._pa.schema([unified.field(k) for k in names])
+        with self._pq.ParquetWriter(self.out_path, schema) as writer:
+            for part in self._parts:
+                table = self._pq.read_table(part)
+                columns = [
+                    table.column(k).cast(schema.field(k).type)
+                    if k in table.column_names
+                    else self._pa.nulls(len(table), schema.field(k).type)
+                    for k in names
+                ]
+                writer.write_table(self._pa.Table.from_arrays(columns, schema=schema))
+        for part in self._parts:
+            os.remove(part)
+        self._parts = []
+
+
+SINKS = {
+    ".csv": CSVSink,
+    ".jsonl": JSONLSink,
+    ".parquet": ParquetSink,
+}
+
+
+def open_sink(out_path, flush_every=100):
+    """open the sink matching the extension of `out_path`."""
+    ext = os.path.splitext(out_path)[1].lower()
+    if ext not in SINKS:
+        raise ValueError(f"Unsupported output format {ext}, expected one of {list(SINKS)}.")
+    return SINKS[ext](out_path, flush_every=flush_every)
@@ -1,10 +1,12 @@
-import torch
-from torch import Tensor
+import math
 from typing import List
+import numpy as np
+from ab_rmsd import backend
+from ab_rmsd.backend import torch, Tensor
 
 
 class KabschRMSD:
-    @torch.no_grad()
+    @backend.no_grad
     def rmsd(self, coords_pred: Tensor, coords: Tensor) -> Tensor:
         """
         Calculate the RMSD between two coordinates (without superimpose).
@@ -14,7 +16,7 @@ class KabschRMSD:
         Returns:
             rmsd: (1)
         """
-        rmsd = torch.sqrt(torch.mean(torch.sum(((coords_pred - coords) ** 2), dim=-1)))
+        rmsd = backend.sqrt(backend.mean(backend.sum(((coords_pred - coords) ** 2), axis=-1)))
         return rmsd
 
     def __call__(self, coords_pred: Tensor, coords: Tensor, superimpose=False) -> Tensor:
@@ -34,7 +36,7 @@ class KabschRMSD:
         
         return self.rmsd(coords, coords_pred)
 
-    @torch.no_grad()
+    @backend.no_grad
     def apply_transformation(self, rotation, translation, coords):
         """
         Apply transformation to coordinates.
@@ -54,9 +56,9 @@ class KabschRMSD:
         assert (
             len(coords.shape) == 2 and coords.shape[1] == 3
         ), "coords should be Nx3 but got {}".format(coords.shape)
-        return (rotation @ coords.t()).t() + translation
+        return coords @ backend.swapaxes(rotation) + translation
 
-    @torch.no_grad()
+    @backend.no_grad
     def calc_superimpose_transformation(self, coords_tgt, coords_src):
         """
         Calculate the transformation from source coordinates to target coordinates.
@@ -75,17 +77,436 @@ class KabschRMSD:
             len(coords_src.shape) == 2 and coords_src.shape[1] == 3
         ), "coords_src should be Nx3 but got {}".format(coords_src.shape)
 
-        coords_pred_mean = coords_tgt.mean(dim=0, keepdim=True)  # (1,3)
-        coords_mean = coords_src.mean(dim=0, keepdim=True)  # (1,3)
+        coords_pred_mean = backend.mean(coords_tgt, axis=0, keepdims=True)  # (1,3)
+        coords_mean = backend.mean(coords_src, axis=0, keepdims=True)  # (1,3)
 
-        A = (coords_tgt - coords_pred_mean).transpose(0, 1) @ (coords_src - coords_mean)
+        A = backend.swapaxes(coords_tgt - coords_pred_mean) @ (coords_src - coords_mean)
 
-        U, S, Vt = torch.linalg.svd(A)
+        U, S, Vt = backend.svd(A)
 
-        corr_mat = torch.diag(
-            torch.tensor([1, 1, torch.sign(torch.det(A))], device=coords_tgt.device)
-        )
-        rotation = (U @ corr_mat) @ Vt
-        translation = coords_pred_mean - torch.t(rotation @ coords_mean.t())  # (1,3)
+        corr = backend.ones(3, like=A)
+        corr[2] = _reflection_sign(U, Vt)
+        rotation = (U * corr) @ Vt
+        translation = coords_pred_mean - coords_mean @ backend.swapaxes(rotation)  # (1,3)
+
+        return rotation, translation
+
+    @backend.no_grad
+    def batch_rmsd(self, coords_pred: Tensor, coords: Tensor, mask: Tensor = None) -> Tensor:
+        """
+        Calculate the RMSD of every item in a batch (without superimpose).
+        Args:
+            coords_pred: (B, N, 3)
+            coords: (B, N, 3)
+            mask: (B, N), padded positions are False. Defaults to all True.
+        Returns:
+            rmsd: (B)
+        """
+        sq_dist = backend.sum((coords_pred - coords) ** 2, axis=-1)  # (B, N)
+        if mask is None:
+            return backend.sqrt(backend.mean(sq_dist, axis=-1))
+        mask = backend.astype(mask, sq_dist)
+        return backend.sqrt(backend.sum(sq_dist * mask, axis=-1) / backend.sum(mask, axis=-1))
+
+    @backend.no_grad
+    def batch_apply_transformation(self, rotation, translation, coords):
+        """
+        Apply a transformation to every item in a batch.
+        Args:
+            rotation: (B, 3, 3)
+            translation: (B, 1, 3)
+            coords: (B, N, 3)
+        Returns:
+            transformed coordinates: (B, N, 3)
+        """
+        assert (
+            len(coords.shape) == 3 and coords.shape[-1] == 3
+        ), "coords should be BxNx3 but got {}".format(coords.shape)
+        return coords @ backend.swapaxes(rotation) + translation
+
+    @backend.no_grad
+    def batch_calc_superimpose_transformation(self, coords_tgt, coords_src, mask=None):
+        """
+        Calculate the transformations from source to target coordinates of a
+        padded batch with a single batched SVD.
+
+        Args:
+            coords_tgt: target coordinates, [B, N, 3]
+            coords_src: source coordinates, [B, N, 3]
+            mask: [B, N], padded positions are False. Defaults to all True.
+        Returns:
+            rotation: (B, 3, 3)
+            translation: (B, 1, 3)
+        """
+        assert (
+            len(coords_tgt.shape) == 3 and coords_tgt.shape[-1] == 3
+        ), "coords_tgt should be BxNx3 but got {}".format(coords_tgt.shape)
+        assert (
+            coords_src.shape == coords_tgt.shape
+        ), "coords_src should be {} but got {}".format(coords_tgt.shape, coords_src.shape)
+        if mask is None:
+            weight = backend.ones(coords_tgt.shape[:2] + (1,), like=coords_tgt)
+        else:
+            weight = backend.astype(mask, coords_tgt)[..., None]  # (B, N, 1)
+        n = backend.sum(weight, axis=1, keepdims=True)  # (B, 1, 1)
+
+        coords_tgt_mean = backend.sum(coords_tgt * weight, axis=1, keepdims=True) / n  # (B, 1, 3)
+        coords_src_mean = backend.sum(coords_src * weight, axis=1, keepdims=True) / n  # (B, 1, 3)
+
+        A = backend.swapaxes((coords_tgt - coords_tgt_mean) * weight) @ (
+            coords_src - coords_src_mean
+        )  # (B, 3, 3)
+
+        U, S, Vt = backend.svd(A)
+
+        # reflection correction, flip the last singular vector where U Vt is a reflection.
+        corr = backend.ones((A.shape[0], 3), like=A)
+        corr[:, 2] = _reflection_sign(U, Vt)
+        rotation = (U * corr[:, None, :]) @ Vt
+        translation = coords_tgt_mean - coords_src_mean @ backend.swapaxes(rotation)
 
         return rotation, translation
+
+
+def _reflection_sign(U, Vt):
+    """
+    -1 where `U @ Vt` is a reflection, 1 otherwise.
+    unlike sign(det(A)) this is never 0 for a rank deficient A (collinear / coplanar points,
+    short masked items) and follows the singular vectors actually used for the rotation.
+    """
+    return 1 - 2 * backend.astype(backend.det(U @ Vt) < 0, U)
+
+
+class QCPRMSD(KabschRMSD):
+    """
+    RMSD and superposition with the quaternion characteristic polynomial (QCP) method
+    (Theobald, Acta Cryst. 2005; Liu et al., J. Comput. Chem. 2010).
+
+    The optimal rotation is the quaternion of the largest eigenvalue of a 4x4 key matrix.
+    That eigenvalue is found with a fixed number of Newton steps on the characteristic polynomial, which
+    gives the superimposed RMSD without building the rotation at all. The rotation, when
+    needed, comes from the cofactors of `K - lambda I`. Same interface as `KabschRMSD`.
+
+    Both coordinate sets are reduced to one float64 gram matrix (a single pass over the
+    points), everything after that is 3x3 / 4x4 algebra: on plain floats for a single pair,
+    where tensor calls would cost more than the arithmetic, and vectorized over the batch
+    for the batched methods. See benchmark/bench_superimpose.py.
+    """
+
+    def __init__(self, n_iter=12):
+        if torch is None:
+            raise ImportError("the qcp engine requires torch, use the kabsch engine with the numpy backend.")
+        # Newton starts from min(E0, sqrt(3) |M|_F) >= sigma1 + sigma2 + sigma3 >= lambda_max and converges
+        # in 2-4 steps on real structures, 12 also cover unrelated and collinear point sets.
+        self.n_iter = n_iter
+
+    def __call__(self, coords_pred: Tensor, coords: Tensor, superimpose=False) -> Tensor:
+        """
+        Calculate the RMSD between two coordinates.
+
+        Args:
+            coords_pred: (N, 3)
+            coords: (N, 3)
+        Returns:
+            rmsd: (1)
+        """
+        if superimpose:
+            return self.superimposed_rmsd(coords_pred, coords)
+        return self.rmsd(coords, coords_pred)
+
+    @backend.no_grad
+    def superimposed_rmsd(self, coords_pred: Tensor, coords: Tensor) -> Tensor:
+        """
+        RMSD after optimal superposition, without computing the rotation.
+        Args:
+            coords_pred: (N, 3)
+            coords: (N, 3)
+        Returns:
+            rmsd: (1)
+        """
+        M, E0, n, _, _ = _gram_single(coords, coords_pred)
+        K = _key_matrix_single(M)
+        c2, c1, c0 = _char_poly_single(M, K)
+        lam = _newton_max_root(min(E0, math.sqrt(-1.5 * c2)), c2, c1, c0, self.n_iter)
+        rmsd = math.sqrt(max(2 * (E0 - lam) / n, 0.0))
+        return torch.tensor(rmsd, dtype=coords.dtype, device=coords.device)
+
+    @backend.no_grad
+    def batch_superimposed_rmsd(self, coords_pred: Tensor, coords: Tensor, mask: Tensor = None) -> Tensor:
+        """
+        Args:
+            coords_pred: (B, N, 3)
+            coords: (B, N, 3)
+            mask: (B, N), padded positions are False. Defaults to all True.
+        Returns:
+            rmsd: (B)
+        """
+        M, E0, n, _, _ = self._inner_product(coords, coords_pred, mask)
+        K = self._key_matrix(M)
+        c2, c1, c0 = self._char_poly(M, K)
+        lam = _newton_max_root(torch.minimum(E0, torch.sqrt(-1.5 * c2)), c2, c1, c0, self.n_iter)
+        rmsd = torch.sqrt(torch.clamp(2 * (E0 - lam) / n, min=0))
+        return rmsd.to(coords.dtype)
+
+    @backend.no_grad
+    def calc_superimpose_transformation(self, coords_tgt, coords_src):
+        """
+        Calculate the transformation from source coordinates to target coordinates.
+
+        Args:
+            coords_tgt: target coordinates, [N, 3]
+            coords_src: source coordinates, [N, 3]
+        Returns:
+            rotation: (3,3)
+            translation: (1,3)
+        """
+        assert (
+            len(coords_tgt.shape) == 2 and coords_tgt.shape[1] == 3
+        ), "coords_tgt should be Nx3 but got {}".format(coords_tgt.shape)
+        assert (
+            len(coords_src.shape) == 2 and coords_src.shape[1] == 3
+        ), "coords_src should be Nx3 but got {}".format(coords_src.shape)
+        M, E0, _, tgt_mean, src_mean = _gram_single(coords_tgt, coords_src)
+        K = _key_matrix_single(M)
+        c2, c1, c0 = _char_poly_single(M, K)
+        lam = _newton_max_root(min(E0, math.sqrt(-1.5 * c2)), c2, c1, c0, self.n_iter)
+        rotation = _quaternion_to_rotation_single(_eigenvector_single(K, lam))
+        translation = [[t - sum(r * s for r, s in zip(row, src_mean)) for row, t in zip(rotation, tgt_mean)]]
+        return (
+            torch.tensor(rotation, dtype=coords_tgt.dtype, device=coords_tgt.device),
+            torch.tensor(translation, dtype=coords_tgt.dtype, device=coords_tgt.device),
+        )
+
+    @backend.no_grad
+    def batch_calc_superimpose_transformation(self, coords_tgt, coords_src, mask=None):
+        """
+        Args:
+            coords_tgt: target coordinates, [B, N, 3]
+            coords_src: source coordinates, [B, N, 3]
+            mask: [B, N], padded positions are False. Defaults to all True.
+        Returns:
+            rotation: (B, 3, 3)
+            translation: (B, 1, 3)
+        """
+        assert (
+            len(coords_tgt.shape) == 3 and coords_tgt.shape[-1] == 3
+        ), "coords_tgt should be BxNx3 but got {}".format(coords_tgt.shape)
+        assert (
+            coords_src.shape == coords_tgt.shape
+        ), "coords_src should be {} but got {}".format(coords_tgt.shape, coords_src.shape)
+        M, E0, _, tgt_mean, src_mean = self._inner_product(coords_tgt, coords_src, mask)
+        K = self._key_matrix(M)
+        c2, c1, c0 = self._char_poly(M, K)
+        lam = _newton_max_root(torch.minimum(E0, torch.sqrt(-1.5 * c2)), c2, c1, c0, self.n_iter)
+        q = self._eigenvector(K, lam)
+        rotation = self._quaternion_to_rotation(q)
+        translation = tgt_mean - src_mean @ rotation.transpose(-1, -2)
+        return rotation.to(coords_tgt.dtype), translation.to(coords_tgt.dtype)
+
+    def _inner_product(self, coords_tgt, coords_src, mask=None):
+        """
+        Returns:
+            M: sum of src_i tgt_i^T over the centered coordinates, (B, 3, 3)
+            E0: half the sum of squared norms, (B)
+            n: number of valid points, (B)
+            coords_tgt_mean, coords_src_mean: (B, 1, 3)
+        """
+        X = torch.cat([coords_tgt, coords_src], dim=-1).double()  # (B, N, 6)
+        if mask is None:
+            n = torch.full(X.shape[:1], X.shape[1], dtype=X.dtype, device=X.device)
+        else:
+            weight = mask.to(X.dtype).unsqueeze(-1)  # (B, N, 1)
+            X = X * weight
+            n = weight.sum(dim=(1, 2))
+        total = X.sum(dim=1)  # (B, 6)
+        mean = total / n[:, None]
+        # gram matrix of the centered coordinates, tgt block, src block and their cross terms.
+        G = X.transpose(-1, -2) @ X - total[:, :, None] * mean[:, None, :]  # (B, 6, 6)
+        M = G[:, 3:, :3]
+        E0 = torch.diagonal(G, dim1=-2, dim2=-1).sum(dim=-1) / 2
+        return M, E0, n, mean[:, None, :3], mean[:, None, 3:]
+
+    @staticmethod
+    def _key_matrix(M):
+        Sxx, Sxy, Sxz = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+        Syx, Syy, Syz = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+        Szx, Szy, Szz = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+        K = torch.stack(
+            [
+                torch.stack([Sxx + Syy + Szz, Syz - Szy, Szx - Sxz, Sxy - Syx], dim=-1),
+                torch.stack([Syz - Szy, Sxx - Syy - Szz, Sxy + Syx, Szx + Sxz], dim=-1),
+                torch.stack([Szx - Sxz, Sxy + Syx, -Sxx + Syy - Szz, Syz + Szy], dim=-1),
+                torch.stack([Sxy - Syx, Szx + Sxz, Syz + Szy, -Sxx - Syy + Szz], dim=-1),
+            ],
+            dim=-2,
+        )
+        return K
+
+    @staticmethod
+    def _char_poly(M, K):
+        """c2, c1, c0 of the characteristic polynomial lambda^4 + c2 lambda^2 + c1 lambda + c0 of `K`."""
+        return -2 * M.square().sum(dim=(1, 2)), -8 * torch.det(M), torch.det(K)
+
+    @staticmethod
+    def _eigenvector(K, lam, eps=1e-6):
+        """
+        eigenvector of `K` for `lam`. every row of `K - lam I` is orthogonal to it, so it is
+        the generalized cross product of any three rows, the best conditioned triple is used.
+        items without a well-defined cofactor (degenerate eigenvalues) fall back to `eigh`.
+        """
+        A = K - lam[:, None, None] * torch.eye(4, dtype=K.dtype, device=K.device)
+        # all 16 cofactors with one batched det, candidate `omit` is the cross product of the other rows.
+        other = torch.tensor(_OTHER, device=K.device)
+        minors = torch.det(A[:, other[:, None, :, None], other[None, :, None, :]])  # (B, 4, 4)
+        candidates = minors * torch.tensor(_COFACTOR_SIGN, dtype=K.dtype, device=K.device)
+        norms = candidates.norm(dim=-1)  # (B, 4)
+        q_norm, best = norms.max(dim=-1)
+        q = candidates[torch.arange(K.shape[0], device=K.device), best]
+        degenerate = q_norm <= eps * K.abs().amax(dim=(1, 2)).clamp(min=1) ** 3
+        if bool(degenerate.any()):
+            _, vecs = torch.linalg.eigh(K[degenerate])
+            q[degenerate] = vecs[..., -1]
+            q_norm[degenerate] = 1.0
+        return q / q_norm[:, None]
+
+    @staticmethod
+    def _quaternion_to_rotation(q):
+        a, b, c, d = q.unbind(dim=-1)
+        rotation = torch.stack(
+            [
+                torch.stack([a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)], dim=-1),
+                torch.stack([2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)], dim=-1),
+                torch.stack([2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d], dim=-1),
+            ],
+            dim=-2,
+        )
+        return rotation
+
+
+# the three other rows / columns of every row / column of a 4x4 matrix, and the cofactor signs.
+_OTHER = [[j for j in range(4) if j != i] for i in range(4)]
+_COFACTOR_SIGN = [1.0, -1.0, 1.0, -1.0]
+
+
+def _newton_max_root(lam, c2, c1, c0, n_iter):
+    """
+    largest root of lambda^4 + c2 lambda^2 + c1 lambda + c0 (the largest eigenvalue of the key
+    matrix) by `n_iter` Newton steps from the upper bound `lam`, on floats or element-wise on
+    tensors. Newton decreases monotonically from above the root, where P > 0. once P is within
+    rounding of 0 the root is reached and no step is taken: near a double root (collinear
+    points) P / P' would be rounding noise over ~0.
+    """
+    for _ in range(n_iter):
+        lam2 = lam * lam
+        P = lam2 * lam2 + c2 * lam2 + c1 * lam + c0
+        dP = 4 * lam2 * lam + 2 * c2 * lam + c1
+        lam = lam - P / (dP + (dP == 0)) * (P > 1e-15 * lam2 * lam2)
+    return lam
+
+
+def _gram_single(coords_tgt, coords_src):
+    """`QCPRMSD._inner_product` of a single pair, as floats and (nested) lists."""
+    X = np.empty((coords_tgt.shape[0], 7))
+    X[:, :3] = backend.to_numpy(coords_tgt)
+    X[:, 3:6] = backend.to_numpy(coords_src)
+    X[:, 6] = 1.0
+    # raw gram matrix, the last row holds the coordinate sums and n.
+    G = (X.T @ X).tolist()
+    n = G[6][6]
+    mean = [v / n for v in G[6][:6]]
+    M = [[G[3 + i][j] - G[6][3 + i] * mean[j] for j in range(3)] for i in range(3)]
+    E0 = sum(G[i][i] - G[6][i] * mean[i] for i in range(6)) / 2
+    return M, E0, n, mean[:3], mean[3:]
+
+
+def _det3(a):
+    return (
+        a[0][0] * (a[1][1] * a[2][2] - a[1][2] * a[2][1])
+        - a[0][1] * (a[1][0] * a[2][2] - a[1][2] * a[2][0])
+        + a[0][2] * (a[1][0] * a[2][1] - a[1][1] * a[2][0])
+    )
+
+
+def _minors2(r1, r2):
+    """2x2 minors of the rows `r1`, `r2` of a 4x4 matrix, m[i][k] over columns i, k."""
+    m = [[0.0] * 4 for _ in range(4)]
+    for i in range(4):
+        for k in range(i + 1, 4):
+            m[i][k] = r1[i] * r2[k] - r1[k] * r2[i]
+            m[k][i] = -m[i][k]
+    return m
+
+
+def _cofactors(a, m):
+    """generalized cross product of the row `a` and the two rows of the minors `m`."""
+    return [
+        s * (a[x] * m[y][z] - a[y] * m[x][z] + a[z] * m[x][y])
+        for s, (x, y, z) in zip(_COFACTOR_SIGN, _OTHER)
+    ]
+
+
+def _key_matrix_single(M):
+    (Sxx, Sxy, Sxz), (Syx, Syy, Syz), (Szx, Szy, Szz) = M
+    return [
+        [Sxx + Syy + Szz, Syz - Szy, Szx - Sxz, Sxy - Syx],
+        [Syz - Szy, Sxx - Syy - Szz, Sxy + Syx, Szx + Sxz],
+        [Szx - Sxz, Sxy + Syx, -Sxx + Syy - Szz, Syz + Szy],
+        [Sxy - Syx, Szx + Sxz, Syz + Szy, -Sxx - Syy + Szz],
+    ]
+
+
+def _char_poly_single(M, K):
+    # det(K) by Laplace expansion over the 2x2 minors of rows 0, 1 and their complements in rows 2, 3.
+    m01, m23 = _minors2(K[0], K[1]), _minors2(K[2], K[3])
+    c0 = (
+        m01[0][1] * m23[2][3] - m01[0][2] * m23[1][3] + m01[0][3] * m23[1][2]
+        + m01[1][2] * m23[0][3] - m01[1][3] * m23[0][2] + m01[2][3] * m23[0][1]
+    )
+    return -2 * sum(v * v for row in M for v in row), -8 * _det3(M), c0
+
+
+def _eigenvector_single(K, lam, eps=1e-6):
+    """`QCPRMSD._eigenvector` of a single key matrix."""
+    A = [[K[i][j] - lam * (i == j) for j in range(4)] for i in range(4)]
+    m01, m23 = _minors2(A[0], A[1]), _minors2(A[2], A[3])
+    # omitting row 0, 1, 2 or 3, rows in cyclic order keep the sign of the determinant.
+    candidates = [_cofactors(A[1], m23), _cofactors(A[0], m23), _cofactors(A[3], m01), _cofactors(A[2], m01)]
+    norms = [math.sqrt(sum(v * v for v in q)) for q in candidates]
+    best_norm = max(norms)
+    if best_norm <= eps * max(max(abs(v) for row in K for v in row), 1) ** 3:
+        return np.linalg.eigh(np.array(K))[1][:, -1].tolist()
+    return [v / best_norm for v in candidates[norms.index(best_norm)]]
+
+
+def _quaternion_to_rotation_single(q):
+    a, b, c, d = q
+    return [
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d],
+    ]
+
+
+SUPERIMPOSE_ENGINES = {
+    "kabsch": KabschRMSD,
+    "qcp": QCPRMSD,
+}
+
+
+def pad_coords(coords_list: List[Tensor]):
+    """
+    Stack coordinates of different lengths into a padded batch.
+    Args:
+        coords_list: list of (N_i, 3)
+    Returns:
+        coords: (B, max N_i, 3)
+        mask: (B, max N_i)
+    """
+    max_len = max(c.shape[0] for c in coords_list)
+    ref = coords_list[0]
+    coords = backend.zeros((len(coords_list), max_len, 3), like=ref)
+    mask = backend.zeros((len(coords_list), max_len), like=ref, dtype=bool)
+    for i, c in enumerate(coords_list):
+        coords[i, : c.shape[0]] = c
+        mask[i, : c.shape[0]] = True
+    return coords, mask
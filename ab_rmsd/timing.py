@@ -0,0 +1,174 @@
+"""
+low-overhead stage timers and counters of the scoring pipeline.
+
+Timing is off by default, it is switched on with `$AB_RMSD_TIMING=1` (inherited by
+worker processes) or `enable()`. When it is off a timed stage costs one flag check.
+Stages and counters accumulate into the current item until `take()` returns and
+resets them, the batch runner takes them after every pair and `summarize`s them.
+
+    read         structure file to atom arrays / Bio structure
+    number       ANARCI numbering of a chain sequence (numbering store misses)
+    parse        atom arrays / Bio chains to residue tensors
+    label        CDR labeling of a chain
+    superimpose  Kabsch / QCP superposition
+    region_rmsd  per-region rmsd reduction
+    fnat         fnat subprocess of DockQ
+"""
+import cProfile
+import functools
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+ENABLED = os.environ.get("AB_RMSD_TIMING", "0") != "0"
+
+# stage -> [seconds, calls] and counter -> count of the current item
+_stages = {}
+_counters = {}
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def _add(name, seconds):
+    entry = _stages.get(name)
+    if entry is None:
+        _stages[name] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def stage(name):
+    """time the block as stage `name`."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """decorator, time every call of the function as stage `name`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _add(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def take():
+    """
+    Returns:
+        dict: {"stages": {stage: [seconds, calls]}, "counters": {counter: count}} recorded
+            since the last call, which are then reset.
+    """
+    global _stages, _counters
+    record = {"stages": _stages, "counters": _counters}
+    _stages, _counters = {}, {}
+    return record
+
+
+def merge(record, other):
+    """add the stages and counters of the `take()` record `other` to `record`."""
+    for name, (seconds, calls) in other["stages"].items():
+        entry = record["stages"].setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+    for name, n in other["counters"].items():
+        record["counters"][name] = record["counters"].get(name, 0) + n
+
+
+def summarize(records):
+    """
+    aggregate the per-item `take()` records of a run.
+
+    Args:
+        records (list): dicts with "seconds" (wall time of the item), "stages" and "counters".
+
+    Returns:
+        dict: {stage: {"items", "calls", "total", "mean", "p95"}}, times in seconds per item,
+            with an "item" entry for the wall time; and the counter totals under "counters".
+    """
+    per_stage = {"item": [[r["seconds"], 1] for r in records]}
+    counters = {}
+    for r in records:
+        for name, entry in r["stages"].items():
+            per_stage.setdefault(name, []).append(entry)
+        for name, n in r["counters"].items():
+            counters[name] = counters.get(name, 0) + n
+    summary = {}
+    for name, entries in per_stage.items():
+        seconds = np.array([e[0] for e in entries], dtype=float)
+        summary[name] = {
+            "items": len(entries),
+            "calls": sum(e[1] for e in entries),
+            "total": float(seconds.sum()) if len(seconds) else 0.0,
+            "mean": float(seconds.mean()) if len(seconds) else 0.0,
+            "p95": float(np.percentile(seconds, 95)) if len(seconds) else 0.0,
+        }
+    summary["counters"] = counters
+    return summary
+
+
+def format_summary(summary):
+    lines = ["{:18s} {:>7s} {:>7s} {:>10s} {:>10s} {:>10s}".format(
+        "stage", "items", "calls", "total (s)", "mean (ms)", "p95 (ms)")]
+    for name, s in summary.items():
+        if name == "counters":
+            continue
+        lines.append("{:18s} {:7d} {:7d} {:10.3f} {:10.2f} {:10.2f}".format(
+            name, s["items"], s["calls"], s["total"], s["mean"] * 1000, s["p95"] * 1000))
+    for name, n in sorted(summary["counters"].items()):
+        lines.append("{:18s} {:7d}".format(name, n))
+    return "\n".join(lines)
+
+
+@contextmanager
+def profile(path, top=25):
+    """
+    cProfile and tracemalloc the block, the profile is written to `path`.prof (see `pstats`)
+    and the `top` allocation sites still alive at its end to `path`.mem.txt.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        profiler.dump_stats(path + ".prof")
+        with open(path + ".mem.txt", "w") as f:
+            f.write(f"peak traced memory: {peak / 1024 ** 2:.1f} MiB\n")
+            for stat in snapshot.statistics("lineno")[:top]:
+                f.write(f"{stat}\n")
@@ -1,5 +1,6 @@
-import torch
 import enum
+import numpy as np
+from ab_rmsd import backend
 
 
 class CDR(enum.IntEnum):
@@ -51,6 +52,88 @@ class ChothiaCDRRange:
                 return CDR.L3
 
 
+CHAIN_CDRS = {
+    "heavy": (CDR.H1, CDR.H2, CDR.H3),
+    "light": (CDR.L1, CDR.L2, CDR.L3),
+}
+CHAIN_FV_REGION = {"heavy": "fv-H", "light": "fv-L"}
+# last Chothia resseq of the Fv, see `preprocess_antibody_structure`
+CHAIN_MAX_RESSEQ = {"heavy": 113, "light": 106}
+
+
+# CDR definitions of several schemes as inclusive (start, end) ranges of Chothia resseq
+# (with their insertion codes). chains are only numbered with Chothia, the CDRs of every
+# scheme are derived from that one alignment. Kabat and North are exact on Chothia
+# numbering, IMGT CDRs are mapped to the Chothia positions they span on typical chains.
+CDR_SCHEMES = {
+    "chothia": {cdr: getattr(ChothiaCDRRange, cdr.name) for cdr in CDR},
+    "kabat": {
+        CDR.H1: (31, 35), CDR.H2: (50, 65), CDR.H3: (95, 102),
+        CDR.L1: (24, 34), CDR.L2: (50, 56), CDR.L3: (89, 97),
+    },
+    "north": {
+        CDR.H1: (23, 35), CDR.H2: (50, 58), CDR.H3: (93, 102),
+        CDR.L1: (24, 34), CDR.L2: (49, 56), CDR.L3: (89, 97),
+    },
+    "imgt": {
+        CDR.H1: (26, 33), CDR.H2: (51, 57), CDR.H3: (93, 102),
+        CDR.L1: (27, 32), CDR.L2: (50, 52), CDR.L3: (89, 97),
+    },
+}
+
+
+def _cdr_scheme_table(scheme, chain):
+    table = np.full(CHAIN_MAX_RESSEQ[chain] + 1, NONCDRID, dtype=np.int64)
+    for cdr in CHAIN_CDRS[chain]:
+        start, end = CDR_SCHEMES[scheme][cdr]
+        table[start : end + 1] = cdr
+    return table
+
+
+# {scheme: {chain: CDR id of every Chothia resseq 0..CHAIN_MAX_RESSEQ}}
+CDR_SCHEME_TABLES = {
+    scheme: {chain: _cdr_scheme_table(scheme, chain) for chain in CHAIN_CDRS}
+    for scheme in CDR_SCHEMES
+}
+
+
+def scheme_cdr_name(scheme, cdr):
+    """scheme-qualified region name, e.g. "kabat:CDRH1"."""
+    return f"{scheme}:{CDRID2CDR[cdr]}"
+
+
+def _cdr_anchors(chain_type, flank=2):
+    anchors = {}
+    for cdr in CHAIN_CDRS["heavy" if chain_type == "H" else "light"]:
+        start, end = getattr(ChothiaCDRRange, cdr.name)
+        anchors[CDRID2CDR[cdr] + "-anchor"] = [(start - flank, start - 1), (end + 1, end + flank)]
+    return anchors
+
+
+# optional region sets scored on top of the CDR/Fv regions, see `AntibodyRMSD`.
+# each region is a list of inclusive (start, end) Chothia resseq ranges.
+REGION_SETS = {
+    "framework": {
+        "heavy": {
+            "FRH1": [(1, 25)],
+            "FRH2": [(33, 51)],
+            "FRH3": [(57, 94)],
+            "FRH4": [(103, 113)],
+        },
+        "light": {
+            "FRL1": [(1, 23)],
+            "FRL2": [(35, 49)],
+            "FRL3": [(57, 88)],
+            "FRL4": [(98, 106)],
+        },
+    },
+    "anchors": {
+        "heavy": _cdr_anchors("H"),
+        "light": _cdr_anchors("L"),
+    },
+}
+
+
 class Fragment(enum.IntEnum):
     Heavy = 1
     Light = 2
@@ -256,6 +339,8 @@ ressymb_to_resindex = {
     "Y": 19,
     "X": 20,
 }
+# one-letter code of every residue index, for vectorized lookups
+resindex_to_ressymb = np.array(sorted(ressymb_to_resindex, key=ressymb_to_resindex.get))
 
 
 class AA(enum.IntEnum):
@@ -603,6 +688,17 @@ restype_to_heavyatom_names = {
 for names in restype_to_heavyatom_names.values():
     assert len(names) == max_num_heavyatoms
 
+# (restype, atom name) -> heavy atom slot lookup table, -1 where the atom is not expected.
+heavyatom_names = sorted(
+    {name for names in restype_to_heavyatom_names.values() for name in names if name != ""}
+)
+heavyatom_name_to_id = {name: i for i, name in enumerate(heavyatom_names)}
+restype_heavyatom_slot = np.full([num_aa_types, len(heavyatom_names)], -1, dtype=np.int64)
+for restype, names in restype_to_heavyatom_names.items():
+    for slot, name in enumerate(names):
+        if name != "":
+            restype_heavyatom_slot[restype, heavyatom_name_to_id[name]] = slot
+
 
 backbone_atom_coordinates = {
     AA.ALA: [
@@ -730,19 +826,19 @@ bb_oxygen_coordinate = {
     AA.VAL: (2.154, -1.062, 0.0),
 }
 
-backbone_atom_coordinates_tensor = torch.zeros([21, 3, 3])
-bb_oxygen_coordinate_tensor = torch.zeros([21, 3])
+backbone_atom_coordinates_tensor = np.zeros([21, 3, 3], dtype=np.float32)
+bb_oxygen_coordinate_tensor = np.zeros([21, 3], dtype=np.float32)
 
 
 def make_coordinate_tensors():
     for restype, atom_coords in backbone_atom_coordinates.items():
         for atom_id, atom_coord in enumerate(atom_coords):
-            backbone_atom_coordinates_tensor[restype][atom_id] = torch.FloatTensor(
-                atom_coord
-            )
+            backbone_atom_coordinates_tensor[restype][atom_id] = atom_coord
 
     for restype, bb_oxy_coord in bb_oxygen_coordinate.items():
-        bb_oxygen_coordinate_tensor[restype] = torch.FloatTensor(bb_oxy_coord)
+        bb_oxygen_coordinate_tensor[restype] = bb_oxy_coord
 
 
 make_coordinate_tensors()
+backbone_atom_coordinates_tensor = backend.asarray(backbone_atom_coordinates_tensor)
+bb_oxygen_coordinate_tensor = backend.asarray(bb_oxygen_coordinate_tensor)
@@ -1,66 +1,47 @@
-import torch
+import numpy as np
 from Bio.PDB import Selection
 from Bio.PDB.Residue import Residue
 from easydict import EasyDict
 
-from .constants import AA, max_num_heavyatoms, restype_to_heavyatom_names, BBHeavyAtom
+from .constants import (
+    AA,
+    max_num_heavyatoms,
+    BBHeavyAtom,
+    heavyatom_name_to_id,
+    restype_heavyatom_slot,
+)
+from .pdb_reader import residue_ordinals, residue_starts
+from ab_rmsd import backend, timing
 
 
 class ParsingException(Exception):
     pass
 
 
-def _get_residue_heavyatom_info(res: Residue):
-    pos_heavyatom = torch.zeros([max_num_heavyatoms, 3], dtype=torch.float)
-    mask_heavyatom = torch.zeros(
-        [
-            max_num_heavyatoms,
-        ],
-        dtype=torch.bool,
-    )
-    restype = AA(res.get_resname())
-    for idx, atom_name in enumerate(restype_to_heavyatom_names[restype]):
-        if atom_name == "":
+def _fill_residue_heavyatoms(res: Residue, restype, pos_heavyatom, mask_heavyatom):
+    """write the heavy atoms of `res` into preallocated `pos_heavyatom` (max_num_heavyatoms, 3) / `mask_heavyatom` rows."""
+    slots = restype_heavyatom_slot[restype]
+    for atom in res:
+        name_id = heavyatom_name_to_id.get(atom.get_id(), -1)
+        if name_id < 0 or slots[name_id] < 0:
             continue
-        if atom_name in res:
-            pos_heavyatom[idx] = torch.tensor(
-                res[atom_name].get_coord().tolist(), dtype=pos_heavyatom.dtype
-            )
-            mask_heavyatom[idx] = True
-    return pos_heavyatom, mask_heavyatom
+        pos_heavyatom[slots[name_id]] = atom.get_coord()
+        mask_heavyatom[slots[name_id]] = True
 
 
+@timing.timed("parse")
 def parse_biopython_structure(entity, unknown_threshold=1.0, max_resseq=None):
     chains = Selection.unfold_entities(entity, "C")
     chains.sort(key=lambda c: c.get_id())
-    data = EasyDict(
-        {
-            "chain_id": [],
-            "resseq": [],
-            "icode": [],
-            "res_nb": [],
-            "aa": [],
-            "pos_heavyatom": [],
-            "mask_heavyatom": [],
-        }
-    )
-    tensor_types = {
-        "resseq": torch.LongTensor,
-        "res_nb": torch.LongTensor,
-        "aa": torch.LongTensor,
-        "pos_heavyatom": torch.stack,
-        "mask_heavyatom": torch.stack,
-    }
 
     count_aa, count_unk = 0, 0
-
-    for i, chain in enumerate(chains):
-        seq_this = 0  # Renumbering residues
+    kept = []
+    for chain in chains:
         residues = Selection.unfold_entities(chain, "R")
         residues.sort(
             key=lambda res: (res.get_id()[1], res.get_id()[2])
         )  # Sort residues by resseq-icode
-        for _, res in enumerate(residues):
+        for res in residues:
             resseq_this = int(res.get_id()[1])
             if max_resseq is not None and resseq_this > max_resseq:
                 continue
@@ -75,40 +56,103 @@ def parse_biopython_structure(entity, unknown_threshold=1.0, max_resseq=None):
             if restype == AA.UNK:
                 count_unk += 1
                 continue
+            kept.append((chain.get_id(), res, restype))
 
-            # Chain info
-            data.chain_id.append(chain.get_id())
+    if len(kept) == 0:
+        raise ParsingException("No parsed residues.")
 
-            # Residue types
-            data.aa.append(restype)  # Will be automatically cast to torch.long
+    if (count_unk / count_aa) >= unknown_threshold:
+        raise ParsingException(
+            f"Too many unknown residues, threshold {unknown_threshold:.2f}."
+        )
 
-            # Heavy atoms
-            pos_heavyatom, mask_heavyatom = _get_residue_heavyatom_info(res)
-            data.pos_heavyatom.append(pos_heavyatom)
-            data.mask_heavyatom.append(mask_heavyatom)
+    # Heavy atoms, filled in place into one preallocated buffer
+    pos_heavyatom = np.zeros([len(kept), max_num_heavyatoms, 3], dtype=np.float32)
+    mask_heavyatom = np.zeros([len(kept), max_num_heavyatoms], dtype=bool)
+    chain_id, resseq, icode, aa = [], [], [], []
+    for i, (c, res, restype) in enumerate(kept):
+        _fill_residue_heavyatoms(res, restype, pos_heavyatom[i], mask_heavyatom[i])
+        chain_id.append(c)
+        aa.append(restype)
+        resseq.append(int(res.get_id()[1]))
+        icode.append(res.get_id()[2])
 
-            # Sequential number
-            resseq_this = int(res.get_id()[1])
-            icode_this = res.get_id()[2]
-            if seq_this == 0:
-                seq_this = 1
-            else:
-                d_CA_CA = torch.linalg.norm(
-                    data.pos_heavyatom[-2][BBHeavyAtom.CA]
-                    - data.pos_heavyatom[-1][BBHeavyAtom.CA],
-                    ord=2,
-                ).item()
-                if d_CA_CA <= 4.0:
-                    seq_this += 1
-                else:
-                    d_resseq = resseq_this - data.resseq[-1]
-                    seq_this += max(2, d_resseq)
-
-            data.resseq.append(resseq_this)
-            data.icode.append(icode_this)
-            data.res_nb.append(seq_this)
-
-    if len(data.aa) == 0:
+    resseq = np.array(resseq, dtype=np.int64)
+    res_nb = _sequential_numbers(chain_id, resseq, pos_heavyatom[:, BBHeavyAtom.CA])
+
+    data = EasyDict(
+        {
+            "chain_id": chain_id,
+            "resseq": backend.asarray(resseq),
+            "icode": icode,
+            "res_nb": backend.asarray(res_nb),
+            "aa": backend.asarray(np.array(aa, dtype=np.int64)),
+            "pos_heavyatom": backend.asarray(pos_heavyatom),
+            "mask_heavyatom": backend.asarray(mask_heavyatom),
+        }
+    )
+    seq_map = {}
+    for i, (c, r, ic) in enumerate(zip(chain_id, resseq.tolist(), icode)):
+        seq_map[(c, r, ic)] = i
+    return data, seq_map
+
+
+def _sequential_numbers(chain_id, resseq, pos_CA):
+    """sequential residue numbers, gaps (CA-CA > 4A) advance by max(2, resseq difference)."""
+    chain_id = np.asarray(chain_id)
+    resseq = np.asarray(resseq, dtype=np.int64)
+    n = len(chain_id)
+    chain_start = np.ones(n, dtype=bool)
+    chain_start[1:] = chain_id[1:] != chain_id[:-1]
+
+    d_CA_CA = np.sqrt(np.square(pos_CA[1:] - pos_CA[:-1]).sum(-1))
+    step = np.ones(n, dtype=np.int64)
+    step[1:] = np.where(d_CA_CA <= 4.0, 1, np.maximum(2, resseq[1:] - resseq[:-1]))
+    step[chain_start] = 1
+
+    # cumulative sum, restarted at the first residue of every chain
+    total = np.cumsum(step)
+    start = np.maximum.accumulate(np.where(chain_start, np.arange(n), 0))
+    return total - total[start] + 1
+
+
+@timing.timed("parse")
+def parse_atom_array(atoms, chain_ids, unknown_threshold=1.0, max_resseq=None):
+    """
+    same as `parse_biopython_structure`, from the per-atom arrays of `pdb_reader.read_pdb_atoms`.
+
+    Args:
+        atoms (EasyDict): per-atom arrays. with `coord_models` (see `read_pdb_lines`),
+            the models are packed into `pos_heavyatom_models` as well.
+        chain_ids (list): chains to parse.
+    """
+    starts = residue_starts(atoms)
+    n_res = len(starts)
+    atom_res = residue_ordinals(atoms)
+
+    res_chain = atoms.chain_id[starts]
+    res_seq = atoms.resseq[starts]
+    res_icode = atoms.icode[starts]
+    names, inverse = np.unique(atoms.resname[starts], return_inverse=True)
+    res_is_aa = np.array([AA.is_aa(str(n)) for n in names], dtype=bool)[inverse]
+    res_type = np.array(
+        [AA(str(n)) if AA.is_aa(str(n)) else AA.UNK for n in names], dtype=np.int64
+    )[inverse]
+
+    ok = np.isin(res_chain, list(chain_ids)) & res_is_aa
+    if max_resseq is not None:
+        ok &= res_seq <= max_resseq
+    for atom_name in ("CA", "C", "N"):
+        ok &= np.bincount(atom_res[atoms.atom_name == atom_name], minlength=n_res) > 0
+    count_aa = int(ok.sum())
+    unk = ok & (res_type == AA.UNK)
+    count_unk = int(unk.sum())
+    ok &= ~unk
+
+    # chains sorted by id, residues by resseq-icode
+    order = np.lexsort((res_icode, res_seq, res_chain))
+    kept = order[ok[order]]
+    if len(kept) == 0:
         raise ParsingException("No parsed residues.")
 
     if (count_unk / count_aa) >= unknown_threshold:
@@ -116,13 +160,54 @@ def parse_biopython_structure(entity, unknown_threshold=1.0, max_resseq=None):
             f"Too many unknown residues, threshold {unknown_threshold:.2f}."
         )
 
-    seq_map = {}
-    for i, (chain_id, resseq, icode) in enumerate(
-        zip(data.chain_id, data.resseq, data.icode)
-    ):
-        seq_map[(chain_id, resseq, icode)] = i
+    # Heavy atoms, scattered to their (residue, slot) through the lookup table
+    row_of_res = np.full(n_res, -1, dtype=np.int64)
+    row_of_res[kept] = np.arange(len(kept))
+    aa = res_type[kept]
+    atom_row = row_of_res[atom_res]
+    atom_name_id = np.array(
+        [heavyatom_name_to_id.get(str(n), -1) for n in atoms.atom_name], dtype=np.int64
+    )
+    valid = (atom_row >= 0) & (atom_name_id >= 0)
+    slot = np.full(len(atom_row), -1, dtype=np.int64)
+    slot[valid] = restype_heavyatom_slot[aa[atom_row[valid]], atom_name_id[valid]]
+    valid &= slot >= 0
+
+    mask_heavyatom = np.zeros([len(kept), max_num_heavyatoms], dtype=bool)
+    mask_heavyatom[atom_row[valid], slot[valid]] = True
+    if "coord_models" in atoms:
+        # all models of an ensemble, (M, L, max_num_heavyatoms, 3), the first one is `pos_heavyatom`.
+        n_models = atoms.coord_models.shape[1]
+        pos_heavyatom_models = np.zeros(
+            [n_models, len(kept), max_num_heavyatoms, 3], dtype=np.float32
+        )
+        pos_heavyatom_models[:, atom_row[valid], slot[valid]] = np.swapaxes(
+            atoms.coord_models[valid], 0, 1
+        )
+        pos_heavyatom = pos_heavyatom_models[0]
+    else:
+        pos_heavyatom = np.zeros([len(kept), max_num_heavyatoms, 3], dtype=np.float32)
+        pos_heavyatom[atom_row[valid], slot[valid]] = atoms.coord[valid]
 
-    for key, convert_fn in tensor_types.items():
-        data[key] = convert_fn(data[key])
+    chain_id = [str(c) for c in res_chain[kept]]
+    resseq = res_seq[kept]
+    icode = [str(c) for c in res_icode[kept]]
+    res_nb = _sequential_numbers(chain_id, resseq, pos_heavyatom[:, BBHeavyAtom.CA])
 
+    data = EasyDict(
+        {
+            "chain_id": chain_id,
+            "resseq": backend.asarray(resseq),
+            "icode": icode,
+            "res_nb": backend.asarray(res_nb),
+            "aa": backend.asarray(aa),
+            "pos_heavyatom": backend.asarray(pos_heavyatom),
+            "mask_heavyatom": backend.asarray(mask_heavyatom),
+        }
+    )
+    if "coord_models" in atoms:
+        data.pos_heavyatom_models = backend.asarray(pos_heavyatom_models)
+    seq_map = {}
+    for i, (c, r, ic) in enumerate(zip(chain_id, resseq.tolist(), icode)):
+        seq_map[(c, r, ic)] = i
     return data, seq_map
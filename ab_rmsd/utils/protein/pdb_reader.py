@@ -0,0 +1,243 @@
+import gzip
+import io
+
+import numpy as np
+from Bio.PDB import MMCIFParser, PDBParser
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+from easydict import EasyDict
+
+from ab_rmsd import timing
+
+PDB_LINE_WIDTH = 80
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _column(raw, start, end):
+    """fixed-width column [start, end) of every record as a bytes array."""
+    return np.ascontiguousarray(raw[:, start:end]).view(f"S{end - start}").ravel()
+
+
+def _strip(col, dtype):
+    return np.char.strip(col).astype(dtype)
+
+
+def read_pdb_lines(lines, all_models=False):
+    """
+    slice the ATOM/HETATM records of the first model of a pdb file into arrays.
+    no Structure/Residue/Atom objects are built.
+
+    Args:
+        lines (list of bytes): lines of a pdb file.
+        all_models (bool, optional): also read the coordinates of the other models into
+            `coord_models` (N, M, 3), see `_stack_models`. Defaults to False.
+
+    Returns:
+        EasyDict: per-atom arrays `atom_name`, `resname`, `chain_id`, `resseq`, `icode`,
+            `hetero`, `coord` (N, 3) and `res_index`, the ordinal of the residue of every atom.
+            residues follow the Bio.PDB convention, consecutive atoms with the same chain,
+            resseq, icode and hetero flag. of alternate locations only the one with the highest
+            occupancy is kept, the first of equal ones, as `Bio.PDB.DisorderedAtom` does.
+    """
+    models = [[]]
+    for line in lines:
+        record = line[:6]
+        if record == b"ATOM  " or record == b"HETATM":
+            models[-1].append(line)
+        elif record == b"ENDMDL":
+            if not all_models:
+                break
+            models.append([])
+    models = [records for records in models if records] or [[]]
+    if all_models:
+        return _stack_models([_read_pdb_records(records) for records in models])
+    return _read_pdb_records(models[0])
+
+
+def _read_pdb_records(records):
+    raw = np.array(records, dtype=f"S{PDB_LINE_WIDTH}").view(np.uint8)
+    raw = raw.reshape(len(records), PDB_LINE_WIDTH)
+
+    atoms = EasyDict(
+        {
+            "atom_name": _strip(_column(raw, 12, 16), "U4"),
+            "resname": _strip(_column(raw, 17, 20), "U3"),
+            "chain_id": _column(raw, 21, 22).astype("U1"),
+            "resseq": _column(raw, 22, 26).astype(np.int64),
+            "icode": _column(raw, 26, 27).astype("U1"),
+            "hetero": _column(raw, 0, 6) == b"HETATM",
+            "coord": np.stack(
+                [_column(raw, s, s + 8).astype(np.float32) for s in (30, 38, 46)],
+                axis=-1,
+            ),
+        }
+    )
+    atoms.chain_id[atoms.chain_id == ""] = " "
+    atoms.icode[atoms.icode == ""] = " "
+    altloc = _column(raw, 16, 17).astype("U1")
+    return _index_residues(atoms, altloc, lambda: _occupancy(_column(raw, 54, 60)))
+
+
+def _occupancy(col):
+    """occupancy column, blank or missing values are 0."""
+    col = np.char.strip(col.astype("U"))
+    col[(col == "") | (col == "?") | (col == ".")] = "0"
+    return col.astype(np.float32)
+
+
+def _index_residues(atoms, altloc, occupancy):
+    """
+    add `res_index` to `atoms` and drop alternate locations but the one with the highest
+    occupancy, the first of equal ones. `occupancy` returns the per-atom occupancy, it is
+    only called if the structure has alternate locations.
+    """
+    # residue boundaries, wherever chain, resseq, icode or hetero flag changes.
+    new_res = np.ones(len(atoms.resseq), dtype=bool)
+    new_res[1:] = (
+        (atoms.chain_id[1:] != atoms.chain_id[:-1])
+        | (atoms.resseq[1:] != atoms.resseq[:-1])
+        | (atoms.icode[1:] != atoms.icode[:-1])
+        | (atoms.hetero[1:] != atoms.hetero[:-1])
+    )
+    atoms.res_index = np.cumsum(new_res) - 1
+
+    # alternate locations: keep the most occupied atom of each name in a residue.
+    if ((altloc != " ") & (altloc != "")).any():
+        key = np.char.add(atoms.res_index.astype("U"), np.char.add(":", atoms.atom_name))
+        _, key = np.unique(key, return_inverse=True)
+        order = np.lexsort((np.arange(len(key)), -occupancy(), key))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = key[order][1:] != key[order][:-1]
+        keep = np.sort(order[first])
+        atoms = EasyDict({k: v[keep] for k, v in atoms.items()})
+    return atoms
+
+
+def _stack_models(models):
+    """
+    atoms of the first model, with the coordinates of all models in `coord_models` (N, M, 3).
+    every model must have the atoms of the first one, in the same order.
+    """
+    atoms = models[0]
+    for i, other in enumerate(models[1:], 2):
+        if len(other.resseq) != len(atoms.resseq) or not all(
+            np.array_equal(atoms[k], other[k])
+            for k in ("atom_name", "resname", "chain_id", "resseq", "icode")
+        ):
+            raise ValueError(f"Model {i} does not have the same atoms as model 1.")
+    atoms.coord_models = np.stack([m.coord for m in models], axis=1)
+    return atoms
+
+
+def read_cif_dict(mmcif_dict, all_models=False):
+    """
+    same as `read_pdb_lines`, from the `_atom_site` columns of a parsed mmcif file.
+    names follow `Bio.PDB.MMCIFParser`, label atom and residue names with author chain ids and numbers.
+
+    Args:
+        mmcif_dict (dict): `Bio.PDB.MMCIF2Dict.MMCIF2Dict` of the file.
+        all_models (bool, optional): see `read_pdb_lines`. Defaults to False.
+    """
+    if "_atom_site.pdbx_PDB_model_num" in mmcif_dict:
+        model = np.array(mmcif_dict["_atom_site.pdbx_PDB_model_num"])
+    else:
+        model = np.full(len(mmcif_dict["_atom_site.Cartn_x"]), "1")
+    _, first = np.unique(model, return_index=True)
+    model_nums = model[np.sort(first)]
+    if all_models:
+        return _stack_models([_read_cif_model(mmcif_dict, model == m) for m in model_nums])
+    return _read_cif_model(mmcif_dict, model == model_nums[0])
+
+
+def _read_cif_model(mmcif_dict, selected):
+    def column(key, dtype="U"):
+        return np.array(mmcif_dict[key])[selected].astype(dtype)
+
+    def missing_to_blank(col):
+        col[(col == "?") | (col == ".")] = " "
+        return col
+
+    atoms = EasyDict(
+        {
+            "atom_name": column("_atom_site.label_atom_id"),
+            "resname": column("_atom_site.label_comp_id"),
+            "chain_id": column("_atom_site.auth_asym_id"),
+            "resseq": column("_atom_site.auth_seq_id", np.int64),
+            "icode": missing_to_blank(column("_atom_site.pdbx_PDB_ins_code")),
+            "hetero": column("_atom_site.group_PDB") == "HETATM",
+            "coord": np.stack(
+                [column(f"_atom_site.Cartn_{x}", np.float32) for x in "xyz"], axis=-1
+            ),
+        }
+    )
+    return _index_residues(
+        atoms,
+        missing_to_blank(column("_atom_site.label_alt_id")),
+        lambda: _occupancy(column("_atom_site.occupancy")),
+    )
+
+
+def open_structure(path):
+    """
+    open a .pdb or .cif file, gzip compressed or not, telling them apart from their content.
+    compressed files are decompressed while reading.
+
+    Returns:
+        tuple: binary file object at the start of the file, and "pdb" or "cif".
+    """
+    f = open(path, "rb")
+    if f.read(2) == GZIP_MAGIC:
+        f.close()
+        f = gzip.open(path, "rb")
+    else:
+        f.seek(0)
+    fmt = "pdb"
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith(b"#"):
+            fmt = "cif" if line.startswith(b"data_") else "pdb"
+            break
+    f.seek(0)
+    return f, fmt
+
+
+@timing.timed("read")
+def read_structure(path, structure_id=None):
+    """read the Bio.PDB structure of a .pdb / .cif file, see `open_structure`."""
+    f, fmt = open_structure(path)
+    parser = MMCIFParser(QUIET=True) if fmt == "cif" else PDBParser(QUIET=True)
+    with io.TextIOWrapper(f) as handle:
+        return parser.get_structure(structure_id, handle)
+
+
+@timing.timed("read")
+def read_pdb_atoms(path, all_models=False):
+    """read the first model of the .pdb / .cif file at `path`, see `read_pdb_lines` and `open_structure`."""
+    f, fmt = open_structure(path)
+    with f:
+        if fmt == "cif":
+            return read_cif_dict(MMCIF2Dict(io.TextIOWrapper(f)), all_models)
+        return read_pdb_lines(f.read().splitlines(), all_models)
+
+
+def select_atoms(atoms, mask):
+    return EasyDict({k: v[mask] for k, v in atoms.items()})
+
+
+def residue_starts(atoms):
+    """index of the first atom of every residue."""
+    starts = np.ones(len(atoms.res_index), dtype=bool)
+    starts[1:] = atoms.res_index[1:] != atoms.res_index[:-1]
+    return np.flatnonzero(starts)
+
+
+def residue_ordinals(atoms):
+    """ordinal of the residue of every atom, 0..n_res-1, even after residues were removed."""
+    ordinals = np.zeros(len(atoms.res_index), dtype=np.int64)
+    ordinals[1:] = atoms.res_index[1:] != atoms.res_index[:-1]
+    return np.cumsum(ordinals)
+
+
+def chain_ids_in_order(atoms):
+    """chain ids in order of first appearance."""
+    _, first = np.unique(atoms.chain_id, return_index=True)
+    return [str(c) for c in atoms.chain_id[np.sort(first)]]
@@ -1,9 +1,9 @@
-import torch
 import warnings
 from Bio import BiopythonWarning
 from Bio.PDB import PDBIO
 from Bio.PDB.StructureBuilder import StructureBuilder
 from .protein.constants import AA, Fragment, restype_to_heavyatom_names
+from ab_rmsd.backend import torch  # None with the numpy backend, `save_pdb` and `MergeChains` need torch.
 
 
 def exists(x):
@@ -1,73 +1,293 @@
-from ab_rmsd import calc_ab_rmsd
+# the rmsd path and DockQ are imported by the mode that needs them, see `rmsd_batch` and `dockQ_batch`.
+from ab_rmsd.sinks import open_sink
+from ab_rmsd.checkpoint import Manifest, hash_inputs
+from ab_rmsd import timing
 import os
-import pandas as pd
+import time
+import json
+import contextlib
+import functools
 import argparse
-from DockQ.DockQ import calc_DockQ
+from concurrent.futures import ProcessPoolExecutor
 
 def parse_arg():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", type=str, default='rmsd',help='calculate the rmsd or dockQ.')
+    parser.add_argument("--mode", type=str, default='rmsd',help='calculate the rmsd or dockQ, or precompute a bundle of the parsed natives of --native_dir at --out_path.')
     parser.add_argument('--native_dir', type=str, default='/user/taosheng/pzz/antibody_data/benchmark_data/igfold_benchmark/pair/')
     parser.add_argument('--pred_dir', type=str, default='/user/taosheng/pzz/antibody_data/predict/igfold_benchmark/alphafold2-m/pair')
-    parser.add_argument('--out_path', type=str, default='./igfold.csv')
+    parser.add_argument('--out_path', type=str, default=None, help='output file, .csv, .jsonl or .parquet (default ./igfold.csv), or the bundle of --mode precompute (default ./natives.bundle).')
+    parser.add_argument('--flush_every', type=int, default=100, help='flush the output file every n results.')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes, 1 runs in the main process.')
+    parser.add_argument('--chunksize', type=int, default=1, help='number of pairs sent to a worker at a time.')
+    parser.add_argument('--resume', action='store_true', help='record completed pairs in <out_path>.manifest.jsonl and reuse the results of pairs whose inputs did not change since the last --resume run.')
+    parser.add_argument('--native_bundle', type=str, default=None, help='bundle written by --mode precompute, natives found in it are not parsed again.')
+    parser.add_argument('--ensemble', action='store_true', help='score every model of multi-model predictions, one row per model.')
+    parser.add_argument('--cdr_schemes', nargs='+', default=(), choices=['chothia', 'kabat', 'north', 'imgt'], help='also score the CDRs of these schemes, as kabat:CDRH1, ... columns.')
+    parser.add_argument('--force_renumber', action='store_true', help='number every chain with ANARCI, also the ones that are already Chothia numbered.')
+    parser.add_argument('--ig_filter', type=float, default=None, help='chains scoring below this in ab_number.ig_likeness are not aligned with ANARCI (default 0.5, also $AB_RMSD_IG_FILTER), 0 aligns every chain.')
+    parser.add_argument('--prefetch', type=int, default=0, help='number the chains of n pairs at a time in one ANARCI batch before scoring them, 0 numbers every chain on its own.')
+    parser.add_argument('--timing', action='store_true', help='time the stages of every pair (also $AB_RMSD_TIMING=1), print a summary and write it to <out_path>.timing.json.')
+    parser.add_argument('--profile_slowest', type=int, default=0, help='cProfile / tracemalloc every pair, keep the dumps of the n slowest in <out_dir>/profiles.')
     args = parser.parse_args()
     return args
 
 
+def _calc_pair(calc_fn, id, pred_path, native_path, profile_dir=None):
+    """
+    run `calc_fn` on a single pair, catching the exception so that one bad
+    pair does not kill the whole run.
+    if `profile_dir` is given, the pair is profiled to `profile_dir`/`id`, see `timing.profile`.
+
+    Returns:
+        tuple: (id, result or None, error message or None, timing record of the pair)
+    """
+    timing.take()  # drop what was recorded outside of a pair
+    start = time.perf_counter()
+    result, error_msg = None, None
+    try:
+        if profile_dir is not None:
+            with timing.profile(os.path.join(profile_dir, id)):
+                result = calc_fn(pred_path, native_path)
+        else:
+            result = calc_fn(pred_path, native_path)
+    except Exception as e:
+        error_msg = f"[Error] {e}. \n native path: {native_path} \n pred path: {pred_path}"
+    record = timing.take()
+    record["seconds"] = time.perf_counter() - start
+    return id, result, error_msg, record
+
+
+def _star_calc_pair(args):
+    return _calc_pair(*args)
+
+
+def _calc_batch(jobs):
+    """
+    number the chains of all files of `jobs` in one ANARCI batch (see `prefetch_numbering`),
+    then `_calc_pair` every job, whose numberings are then found in the numbering store.
+    """
+    from ab_rmsd.ab_number import prefetch_numbering
+
+    timing.take()
+    start = time.perf_counter()
+    prefetch_numbering([path for job in jobs for path in job[2:4]])
+    prefetch_record = timing.take()
+    prefetch_record["seconds"] = time.perf_counter() - start
+    results = [_calc_pair(*job) for job in jobs]
+    if len(results) > 0:
+        # the batch numbering is accounted to the first pair of the batch.
+        timing.merge(results[0][3], prefetch_record)
+        results[0][3]["seconds"] += prefetch_record["seconds"]
+    return results
+
+
+def _iter_results(jobs, workers=1, chunksize=1, prefetch=0):
+    """
+    yield `_calc_pair` results of `jobs` in submission order.
+    with `prefetch`, jobs are sent in batches of `prefetch` pairs, see `_calc_batch`.
+    """
+    if prefetch > 0:
+        batches = [jobs[i : i + prefetch] for i in range(0, len(jobs), prefetch)]
+        for results in _map(_calc_batch, batches, workers, 1):
+            yield from results
+        return
+    yield from _map(_star_calc_pair, jobs, workers, chunksize)
+
+
+def _map(fn, items, workers=1, chunksize=1):
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    # `map` yields results in submission order, regardless of which worker finishes first.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(fn, items, chunksize=max(1, chunksize))
+
+
+def _write_result(sink, id, result):
+    """an ensemble result (list of per-model results) is written as one row per model."""
+    if isinstance(result, list):
+        for i, model_result in enumerate(result, 1):
+            sink.write(f"{id}_model_{i}", model_result)
+    else:
+        sink.write(id, result)
+
+
+def _calc_fn_name(calc_fn):
+    if isinstance(calc_fn, functools.partial):
+        # options that change the result are part of the name, so that --resume recomputes pairs when they change.
+        options = {k: v for k, v in calc_fn.keywords.items() if k != 'cache_native'}
+        return _calc_fn_name(calc_fn.func) + (repr(sorted(options.items())) if options else '')
+    return calc_fn.__name__
+
 
 def run(
     calc_fn,
     native_dir,
     pred_dir,
     out_path = './result.csv',
-    
+    workers = 1,
+    chunksize = 1,
+    flush_every = 100,
+    resume = False,
+    timed = False,
+    profile_slowest = 0,
+    prefetch = 0,
 ):
-    res = {}
     errors = []
-    for pdb_file in os.listdir(pred_dir):
+    if timed:
+        # worker processes that do not inherit the flag read it from the environment.
+        os.environ['AB_RMSD_TIMING'] = '1'
+        timing.enable()
+    profile_dir = None
+    if profile_slowest > 0:
+        profile_dir = os.path.join(os.path.dirname(out_path), 'profiles')
+        os.makedirs(profile_dir, exist_ok=True)
+    # sort the files so that the output order does not depend on the file system.
+    jobs = []
+    digests = {}
+    # natives are matched by id, so that e.g. a .cif.gz native pairs with a .pdb prediction.
+    native_files = sorted(os.listdir(native_dir))
+    natives = {}
+    for native_file in native_files:
+        natives.setdefault(native_file.split('.')[0], native_file)
+    for pdb_file in sorted(os.listdir(pred_dir)):
+        id = pdb_file.split('.')[0]
+        native_file = pdb_file if pdb_file in native_files else natives.get(id, pdb_file)
+        native_path = os.path.join(native_dir, native_file)
+        pred_path = os.path.join(pred_dir, pdb_file)
+        jobs.append((calc_fn, id, pred_path, native_path, profile_dir))
+        if not resume:
+            continue
         try:
-            id = pdb_file.split('.')[0]
-            native_path = os.path.join(native_dir, pdb_file)
-            pred_path = os.path.join(pred_dir, pdb_file)
-            rmsd = calc_fn(pred_path,native_path)
-            res[id] = rmsd
-        except Exception as e:
-            error_msg = f"[Error] {e}. \n native path: {native_path} \n pred path: {pred_path}"
-            print(error_msg)
-            errors.append(error_msg)
-        
+            digests[id] = hash_inputs(pred_path, native_path, tag=_calc_fn_name(calc_fn))
+        except OSError:
+            digests[id] = None  # let `calc_fn` report the missing file.
+
+    # with --resume, completed pairs are recorded with the hash of their inputs, see `Manifest`.
+    manifest_path = out_path + '.manifest.jsonl'
+    with Manifest(manifest_path) if resume else contextlib.nullcontext() as manifest:
+        done = {}
+        todo = []
+        for job in jobs:
+            id = job[1]
+            result = manifest.get(id, digests[id]) if resume else None
+            if result is not None:
+                done[id] = result
+            else:
+                todo.append(job)
+        if resume:
+            print(f"[INFO] resuming from {manifest_path}, {len(done)} of {len(jobs)} pairs unchanged.")
+
+        # results are streamed to `out_path` as they complete, the mean row is added on close.
+        results = _iter_results(todo, workers, chunksize, prefetch)
+        records = {}
+        with open_sink(out_path, flush_every) as sink:
+            for job in jobs:
+                id = job[1]
+                if id in done:
+                    _write_result(sink, id, done[id])
+                    continue
+                id, rmsd, error_msg, records[id] = next(results)
+                if error_msg is None:
+                    if resume:
+                        manifest.add(id, digests[id], rmsd)
+                    _write_result(sink, id, rmsd)
+                else:
+                    print(error_msg)
+                    errors.append(error_msg)
+    mean = sink.running_mean.mean()
             
     # save error massage
     out_dir = os.path.dirname(out_path)
     with open(os.path.join(out_dir, 'errors.log'), 'w') as f:
         f.write('\n'.join(errors))
         
-    # save rmsd statistics
-    df = pd.DataFrame(res).T
-    df.loc['mean'] = df.mean()
-    df.to_csv(out_path,float_format='%.3f')
-    pd.options.display.float_format = '{:.2f}'.format
-    print(df)
+    # print rmsd statistics
+    print(f"[INFO] {sink.n_written} results written to {out_path}, {len(errors)} errors.")
+    print("mean")
+    for k, v in mean.items():
+        print('{:12s}\t{:.2f}'.format(k, v))
+    if sink.running_mean.non_finite:
+        print(f"[INFO] non-finite values left out of the mean: {sink.running_mean.non_finite}")
+
+    if timed and len(records) > 0:
+        summary = timing.summarize(list(records.values()))
+        with open(out_path + '.timing.json', 'w') as f:
+            json.dump({"summary": summary, "pairs": records}, f, indent=1)
+        print("[INFO] timing")
+        print(timing.format_summary(summary))
+    if profile_dir is not None:
+        # every pair was profiled, keep the dumps of the slowest ones.
+        slowest = sorted(records, key=lambda id: records[id]["seconds"], reverse=True)
+        for id in slowest[profile_slowest:]:
+            for ext in ('.prof', '.mem.txt'):
+                if os.path.exists(os.path.join(profile_dir, id + ext)):
+                    os.remove(os.path.join(profile_dir, id + ext))
+        print(f"[INFO] profiles of the {min(profile_slowest, len(slowest))} slowest pairs in {profile_dir}:")
+        for id in slowest[:profile_slowest]:
+            print('{:12s}\t{:.3f}s'.format(id, records[id]["seconds"]))
     
 def dockQ_batch(
     native_dir,
     pred_dir,
     out_path = './result.csv',
+    workers = 1,
+    chunksize = 1,
+    flush_every = 100,
+    resume = False,
+    timed = False,
+    profile_slowest = 0,
 ):
-    run(calc_DockQ,native_dir,pred_dir,out_path)
+    from DockQ.DockQ import calc_DockQ
+    run(calc_DockQ,native_dir,pred_dir,out_path,workers,chunksize,flush_every,resume,timed,profile_slowest)
     
 def rmsd_batch(
     native_dir,
     pred_dir,
     out_path = './result.csv',
+    workers = 1,
+    chunksize = 1,
+    flush_every = 100,
+    resume = False,
+    ensemble = False,
+    native_bundle = None,
+    timed = False,
+    profile_slowest = 0,
+    prefetch = 0,
+    cdr_schemes = (),
 ):
-    run(calc_ab_rmsd,native_dir,pred_dir,out_path)
+    from ab_rmsd.calc_rmsd import calc_ab_rmsd, calc_ab_rmsd_ensemble, native_cache
+    from ab_rmsd.number_store import number_store
+    if prefetch > 0 and number_store is None:
+        print("[WARNING] --prefetch needs the numbering store, numbering every chain on its own.")
+        prefetch = 0
+    if native_bundle is not None:
+        # worker processes that do not inherit `native_cache` load it from the environment.
+        os.environ['AB_RMSD_NATIVE_BUNDLE'] = native_bundle
+        native_cache.load_bundle(native_bundle)
+    calc_fn = functools.partial(calc_ab_rmsd_ensemble if ensemble else calc_ab_rmsd, cache_native=True)
+    if len(cdr_schemes) > 0:
+        calc_fn = functools.partial(calc_fn, cdr_schemes=tuple(cdr_schemes))
+    run(calc_fn,native_dir,pred_dir,out_path,workers,chunksize,flush_every,resume,timed,profile_slowest,prefetch)
+    if workers <= 1:
+        print(f"[INFO] native cache: {native_cache.stats()}")
     
 if __name__ == '__main__':
     
     args = parse_arg()
+    if args.force_renumber:
+        # also read by worker processes that do not inherit the module state.
+        os.environ['AB_RMSD_FORCE_RENUMBER'] = '1'
+    if args.ig_filter is not None:
+        os.environ['AB_RMSD_IG_FILTER'] = str(args.ig_filter)
+    if args.out_path is None:
+        args.out_path = './natives.bundle' if args.mode == 'precompute' else './igfold.csv'
     if args.mode == 'rmsd':
-        rmsd_batch(args.native_dir, args.pred_dir, args.out_path)
+        rmsd_batch(args.native_dir, args.pred_dir, args.out_path, args.workers, args.chunksize, args.flush_every, args.resume, args.ensemble, args.native_bundle, args.timing, args.profile_slowest, args.prefetch, args.cdr_schemes)
+    elif args.mode == 'precompute':
+        from ab_rmsd.calc_rmsd import precompute
+        n = precompute(args.native_dir, args.out_path, args.workers)
+        print(f"[INFO] {n} natives of {args.native_dir} written to {args.out_path}.")
     else:
-        dockQ_batch(args.native_dir, args.pred_dir, args.out_path)
-   
\ No newline at end of file
+        dockQ_batch(args.native_dir, args.pred_dir, args.out_path, args.workers, args.chunksize, args.flush_every, args.resume, args.timing, args.profile_slowest)
+   
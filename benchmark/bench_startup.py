@@ -0,0 +1,92 @@
+"""
+startup cost of the entry points, from `python -X importtime`.
+
+the import time of a case is the total over its top-level imports, minus that of a
+bare interpreter. cold runs start without the bytecode of this repository (it is
+compiled again, as after an install or an edit), warm runs reuse it and the best of
+`--repeat` is reported. the runs keep their bytecode under a temporary
+`PYTHONPYCACHEPREFIX`, the `__pycache__` directories of the checkout are left alone.
+every case has a cold and a warm budget in ms, the script exits with status 1 when
+one is exceeded so that it can guard against import-time regressions.
+
+    python benchmark/bench_startup.py
+    python benchmark/bench_startup.py --scale 2  # slower machine
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (python args, extra environment, cold budget ms, warm budget ms)
+CASES = {
+    "import ab_rmsd": (["-c", "import ab_rmsd"], {}, 10, 5),
+    "abrmsd --help": ([os.path.join(REPO, "abrmsd"), "--help"], {}, 60, 40),
+    "calc_ab_rmsd, numpy": (
+        ["-c", "from ab_rmsd import calc_ab_rmsd"], {"AB_RMSD_BACKEND": "numpy"}, 1000, 600
+    ),
+    "calc_ab_rmsd, default": (["-c", "from ab_rmsd import calc_ab_rmsd"], {}, 5000, 4000),
+}
+
+
+def import_time_ms(args, env):
+    """total import time of a python process, summed over its top-level imports."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True,
+    ).stderr
+    total = 0
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):  # top level, nested imports are in its cumulative time
+            total += int(cumulative)
+    return total / 1000
+
+
+def clear_bytecode(prefix):
+    """drop the bytecode of this repository from the `PYTHONPYCACHEPREFIX` tree at `prefix`."""
+    mirror = os.path.join(prefix, os.path.splitdrive(REPO)[1].lstrip(os.sep))
+    shutil.rmtree(mirror, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the budgets.")
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="ab_rmsd_pycache.") as prefix:
+        base_env = dict(os.environ, PYTHONPYCACHEPREFIX=prefix)
+        # warm runs need the bytecode the earlier runs write.
+        base_env.pop("PYTHONDONTWRITEBYTECODE", None)
+        base_env["PYTHONPATH"] = os.pathsep.join([REPO, base_env.get("PYTHONPATH", "")])
+        interpreter = min(import_time_ms(["-c", "pass"], base_env) for _ in range(args.repeat + 1))
+        over = []
+        print("{:24s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+            "case", "cold (ms)", "budget", "warm (ms)", "budget"))
+        for name in args.cases:
+            case_args, case_env, cold_budget, warm_budget = CASES[name]
+            env = dict(base_env, **case_env)
+            # the prefix starts empty, compile the dependencies first so only this repository is cold.
+            import_time_ms(case_args, env)
+            clear_bytecode(prefix)
+            cold = import_time_ms(case_args, env) - interpreter
+            warm = min(import_time_ms(case_args, env) for _ in range(args.repeat)) - interpreter
+            cold_budget, warm_budget = cold_budget * args.scale, warm_budget * args.scale
+            print("{:24s} {:10.1f} {:10.0f} {:10.1f} {:10.0f}".format(
+                name, cold, cold_budget, warm, warm_budget))
+            if cold > cold_budget or warm > warm_budget:
+                over.append(name)
+    if over:
+        print(f"over budget: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
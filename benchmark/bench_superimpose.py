@@ -0,0 +1,65 @@
+"""
+compare the SVD (Kabsch) and QCP superimpose engines on random point sets
+of the sizes we superimpose: CDR loops and the Fv backbone.
+
+    python benchmark/bench_superimpose.py --sizes 20 60 360 --batch 1000
+"""
+import argparse
+import os
+import sys
+import timeit
+import torch
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from ab_rmsd.superimpose import KabschRMSD, QCPRMSD  # noqa: E402
+
+
+def random_pairs(batch, n, noise=0.5):
+    coords = torch.randn(batch, n, 3) * 10
+    q = torch.nn.functional.normalize(torch.randn(batch, 4), dim=-1)
+    rot = QCPRMSD._quaternion_to_rotation(q.double()).float()
+    coords_pred = coords @ rot.transpose(-1, -2) + torch.randn(batch, 1, 3) * 5
+    coords_pred = coords_pred + torch.randn_like(coords_pred) * noise
+    return coords_pred, coords
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 60, 360])
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    kabsch, qcp = KabschRMSD(), QCPRMSD()
+    print("{:>5s} {:>12s} {:>12s} {:>12s} {:>14s} {:>14s} {:>10s}".format(
+        "N", "svd (us)", "qcp (us)", "qcp rmsd", "svd batch/it", "qcp batch/it", "max diff"))
+    for n in args.sizes:
+        coords_pred, coords = random_pairs(args.batch, n)
+        p, c = coords_pred[0], coords[0]
+        t_svd = bench(lambda: kabsch(p, c, superimpose=True), args.number)
+        t_qcp = bench(lambda: qcp(p, c, superimpose=True), args.number)
+        t_qcp_rot = bench(lambda: qcp.calc_superimpose_transformation(c, p), args.number)
+
+        def svd_batch():
+            rot, trans = kabsch.batch_calc_superimpose_transformation(coords, coords_pred)
+            return kabsch.batch_rmsd(kabsch.batch_apply_transformation(rot, trans, coords_pred), coords)
+
+        def qcp_batch():
+            return qcp.batch_superimposed_rmsd(coords_pred, coords)
+
+        t_svd_b = bench(svd_batch, max(1, args.number // 20))
+        t_qcp_b = bench(qcp_batch, max(1, args.number // 20))
+        max_diff = (svd_batch() - qcp_batch()).abs().max().item()
+        print("{:5d} {:12.1f} {:12.1f} {:12.1f} {:14.1f} {:14.1f} {:10.2e}".format(
+            n, t_svd * 1e6, t_qcp_rot * 1e6, t_qcp * 1e6,
+            t_svd_b / args.batch * 1e6, t_qcp_b / args.batch * 1e6, max_diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,13 @@ setup(
     'antibody'
   ],
   install_requires=[
-    "torch>=1.7",
+    "numpy",
     "easydict",
     "biopython",
   ],
+  extras_require={
+    "torch": ["torch>=1.7"],
+  },
   classifiers=[
     'Development Status :: 4 - Beta',
     'Intended Audience :: Developers',
@@ -0,0 +1,34 @@
+from ab_rmsd import number_store
+from ab_rmsd.number_store import NumberStore
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = NumberStore(str(tmp_path / "numbering.sqlite"), max_entries=200, touch_batch=1)
+    for i in range(200):
+        store.put(f"SEQ{i}", [("H", (i, " "))], "H")
+    assert store.get("SEQ0") is not None  # now the most recently used
+    for i in range(200, 260):
+        store.put(f"SEQ{i}", [("H", (i, " "))], "H")
+        assert len(store) <= 200
+    assert store.get("SEQ0") is not None
+    assert store.get("SEQ1") is None
+    assert store.get("SEQ259") is not None
+
+
+def test_count_catches_up_with_other_writers(tmp_path):
+    path = str(tmp_path / "numbering.sqlite")
+    store, other = NumberStore(path, max_entries=100), NumberStore(path, max_entries=100)
+    store.put("SEQ", [], "H")
+    for i in range(150):
+        other.put(f"OTHER{i}", [], "H")
+    for i in range(150):
+        store.put(f"SEQ{i}", [], "H")
+    assert len(store) <= 100
+
+
+def test_numberings_of_other_versions_are_not_reused(tmp_path, monkeypatch):
+    store = NumberStore(str(tmp_path / "numbering.sqlite"))
+    store.put("SEQ", error="not an antibody")
+    assert store.get("SEQ") == (None, None, "not an antibody")
+    monkeypatch.setattr(number_store, "numbering_version", lambda: "upgraded")
+    assert store.get("SEQ") is None
@@ -0,0 +1,175 @@
+import glob
+import io
+import os
+
+import numpy as np
+import pytest
+from Bio.PDB import PDBParser
+
+from ab_rmsd import backend
+from ab_rmsd.utils.protein.constants import (
+    AA,
+    BBHeavyAtom,
+    max_num_heavyatoms,
+    restype_to_heavyatom_names,
+)
+from ab_rmsd.utils.protein.parsers import (
+    _sequential_numbers,
+    parse_atom_array,
+    parse_biopython_structure,
+)
+from ab_rmsd.utils.protein.pdb_reader import chain_ids_in_order, read_pdb_lines
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = sorted(glob.glob(os.path.join(REPO, "example", "*.pdb")))
+
+
+def _sequential_numbers_loop(chain_id, resseq, pos_CA):
+    """the per-residue loop `_sequential_numbers` replaced."""
+    res_nb = []
+    seq_this = 0
+    for i in range(len(chain_id)):
+        if i == 0 or chain_id[i] != chain_id[i - 1]:
+            seq_this = 1
+        else:
+            d_CA_CA = np.linalg.norm(pos_CA[i - 1] - pos_CA[i], ord=2).item()
+            if d_CA_CA <= 4.0:
+                seq_this += 1
+            else:
+                d_resseq = int(resseq[i]) - int(resseq[i - 1])
+                seq_this += max(2, d_resseq)
+        res_nb.append(seq_this)
+    return res_nb
+
+
+def _parse_loop(entity, max_resseq=None):
+    """the per-residue loop of `parse_biopython_structure` before it was vectorized, in numpy."""
+    data = {k: [] for k in ("chain_id", "resseq", "icode", "aa", "pos_heavyatom", "mask_heavyatom")}
+    for chain in sorted(entity, key=lambda c: c.get_id()):
+        for res in sorted(chain, key=lambda res: (res.get_id()[1], res.get_id()[2])):
+            if max_resseq is not None and int(res.get_id()[1]) > max_resseq:
+                continue
+            if not AA.is_aa(res.get_resname()):
+                continue
+            if not (res.has_id("CA") and res.has_id("C") and res.has_id("N")):
+                continue
+            restype = AA(res.get_resname())
+            if restype == AA.UNK:
+                continue
+            pos = np.zeros([max_num_heavyatoms, 3], dtype=np.float32)
+            mask = np.zeros([max_num_heavyatoms], dtype=bool)
+            for idx, atom_name in enumerate(restype_to_heavyatom_names[restype]):
+                if atom_name != "" and atom_name in res:
+                    pos[idx] = res[atom_name].get_coord()
+                    mask[idx] = True
+            data["chain_id"].append(chain.get_id())
+            data["resseq"].append(int(res.get_id()[1]))
+            data["icode"].append(res.get_id()[2])
+            data["aa"].append(int(restype))
+            data["pos_heavyatom"].append(pos)
+            data["mask_heavyatom"].append(mask)
+    data = {k: v if k in ("chain_id", "icode") else np.array(v) for k, v in data.items()}
+    data["res_nb"] = np.array(
+        _sequential_numbers_loop(data["chain_id"], data["resseq"], data["pos_heavyatom"][:, BBHeavyAtom.CA])
+    )
+    seq_map = {key: i for i, key in enumerate(zip(data["chain_id"], data["resseq"].tolist(), data["icode"]))}
+    return data, seq_map
+
+
+def _with_breaks_and_icodes(lines):
+    """
+    drop residues 30-34 (a chain break), renumber 52 to 51A (an insertion code),
+    drop the CA of 60 (the residue is skipped) and the side chain of 70 (a partial mask).
+    """
+    edited = []
+    for line in lines:
+        if line[:6] in (b"ATOM  ", b"HETATM"):
+            resseq = int(line[22:26])
+            atom_name = line[12:16].strip()
+            if 30 <= resseq <= 34:
+                continue
+            if resseq == 60 and atom_name == b"CA":
+                continue
+            if resseq == 70 and atom_name not in (b"N", b"CA", b"C", b"O"):
+                continue
+            if resseq == 52:
+                line = line[:22] + b"  51A" + line[27:]
+        edited.append(line)
+    return edited
+
+
+def _read_lines(path, edit):
+    with open(path, "rb") as f:
+        lines = f.read().splitlines()
+    return _with_breaks_and_icodes(lines) if edit else lines
+
+
+def _structure(lines):
+    return PDBParser(QUIET=True).get_structure(None, io.StringIO(b"\n".join(lines).decode()))[0]
+
+
+def _parse_both(lines, max_resseq=None):
+    atoms = read_pdb_lines(lines)
+    data_array, _ = parse_atom_array(atoms, chain_ids_in_order(atoms), max_resseq=max_resseq)
+    data_bio, _ = parse_biopython_structure(_structure(lines), max_resseq=max_resseq)
+    return data_array, data_bio
+
+
+def _check_res_nb(data):
+    pos_CA = backend.to_numpy(data.pos_heavyatom)[:, BBHeavyAtom.CA]
+    expected = _sequential_numbers_loop(
+        data.chain_id, backend.to_numpy(data.resseq), pos_CA
+    )
+    np.testing.assert_array_equal(backend.to_numpy(data.res_nb), expected)
+
+
+@pytest.mark.parametrize("path", EXAMPLES, ids=os.path.basename)
+@pytest.mark.parametrize("edit", [False, True], ids=["as_is", "breaks_icodes"])
+def test_res_nb_matches_loop(path, edit):
+    for data in _parse_both(_read_lines(path, edit)):
+        _check_res_nb(data)
+        if edit:
+            assert "A" in data.icode
+            assert np.diff(backend.to_numpy(data.res_nb)).max() > 1
+
+
+@pytest.mark.parametrize("path", EXAMPLES, ids=os.path.basename)
+@pytest.mark.parametrize("edit", [False, True], ids=["as_is", "breaks_icodes"])
+@pytest.mark.parametrize("max_resseq", [None, 100])
+def test_parsers_match_loop(path, edit, max_resseq):
+    lines = _read_lines(path, edit)
+    expected, expected_seq_map = _parse_loop(_structure(lines), max_resseq)
+    atoms = read_pdb_lines(lines)
+    parsed = {
+        "parse_atom_array": parse_atom_array(atoms, chain_ids_in_order(atoms), max_resseq=max_resseq),
+        "parse_biopython_structure": parse_biopython_structure(_structure(lines), max_resseq=max_resseq),
+    }
+    for name, (data, seq_map) in parsed.items():
+        for field, value in expected.items():
+            actual = data[field]
+            if field in ("chain_id", "icode"):
+                assert list(actual) == value, (name, field)
+            else:
+                np.testing.assert_array_equal(backend.to_numpy(actual), value, err_msg=f"{name} {field}")
+        assert seq_map == expected_seq_map, name
+    if edit:
+        # the residue without CA is left out and the truncated one keeps only its backbone
+        for chain in set(expected["chain_id"]):
+            in_chain = np.array(expected["chain_id"]) == chain
+            assert 60 not in expected["resseq"][in_chain]
+            if 70 in expected["resseq"][in_chain]:
+                mask = expected["mask_heavyatom"][in_chain & (expected["resseq"] == 70)][0]
+                assert mask.sum() == 4
+
+
+def test_sequential_numbers_edge_cases():
+    # a lone residue chain, a gap with a resseq step back and a gap right after a chain start
+    chain_id = ["A", "A", "A", "B", "C", "C", "C"]
+    resseq = np.array([1, 2, 1, 5, 1, 7, 8])
+    pos_CA = np.array(
+        [[0, 0, 0], [3.8, 0, 0], [20, 0, 0], [0, 0, 0], [0, 0, 0], [10, 0, 0], [13.8, 0, 0]],
+        dtype=np.float32,
+    )
+    res_nb = _sequential_numbers(chain_id, resseq, pos_CA)
+    np.testing.assert_array_equal(res_nb, _sequential_numbers_loop(chain_id, resseq, pos_CA))
+    np.testing.assert_array_equal(res_nb, [1, 2, 4, 1, 1, 7, 8])
@@ -0,0 +1,51 @@
+import io
+import json
+import os
+import signal
+import time
+
+import pytest
+
+from ab_rmsd.server import ScoringServer
+
+MISSING = {"pred": "missing_pred.pdb", "native": "missing_native.pdb"}
+
+
+@pytest.fixture
+def server():
+    server = ScoringServer(workers=1)
+    yield server
+    server.close()
+
+
+def _kill_workers(executor):
+    for process in list(executor._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+
+
+def test_killed_worker_is_answered_and_replaced(server):
+    broken = server.executor
+    busy = broken.submit(time.sleep, 30)
+    response = server.submit(json.dumps({"id": 7, **MISSING}))
+    _kill_workers(broken)
+    assert response.result(timeout=60)["id"] == 7
+    assert "BrokenProcessPool" in response.result()["error"]
+    assert busy.exception(timeout=60) is not None
+
+    # later requests are scored by a new pool
+    response = server.submit(json.dumps({"id": 8, **MISSING})).result(timeout=60)
+    assert server.executor is not broken
+    assert response["id"] == 8 and "BrokenProcessPool" not in response["error"]
+
+
+def test_serve_stdin_after_the_pool_broke(server):
+    broken = server.executor
+    broken.submit(os._exit, 1)
+    while not broken._broken:
+        time.sleep(0.01)
+    stdout = io.StringIO()
+    lines = [json.dumps({"id": i, **MISSING}) + "\n" for i in range(3)]
+    server.serve_stdin(io.StringIO("".join(lines)), stdout)
+    responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert sorted(r["id"] for r in responses) == [0, 1, 2]
+    assert all("BrokenProcessPool" not in r["error"] for r in responses)
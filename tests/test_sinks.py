@@ -0,0 +1,57 @@
+import csv
+import math
+import os
+
+import pytest
+
+from ab_rmsd.sinks import open_sink
+
+ROWS = [
+    ("a", {"CDRH1": 1.0, "fv-H": 2.0}),
+    ("b", {"CDRH1": 3.0, "fv-H": 4.0}),
+    # columns first seen after the first flush, one of them an int
+    ("c", {"CDRH1": 5.0, "fv-H": 6.0, "CDRL1": 7.0, "fv-L": 8.0, "nat_total": 55}),
+]
+
+
+def _write(path):
+    with open_sink(path, flush_every=2) as sink:
+        for id, result in ROWS:
+            sink.write(id, result)
+
+
+def test_parquet_keeps_late_columns(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "out.parquet")
+    _write(path)
+
+    table = pq.read_table(path)
+    assert table.column_names == ["id", "CDRH1", "fv-H", "CDRL1", "fv-L", "nat_total"]
+    rows = {row["id"]: row for row in table.to_pylist()}
+    assert set(rows) == {"a", "b", "c", "mean"}
+    assert rows["a"]["CDRL1"] is None and rows["a"]["nat_total"] is None
+    assert rows["c"]["CDRL1"] == 7.0 and rows["c"]["nat_total"] == 55
+    assert rows["mean"]["CDRH1"] == 3.0 and rows["mean"]["fv-L"] == 8.0
+    assert os.listdir(tmp_path) == ["out.parquet"]
+
+
+def test_parquet_keeps_rows_on_error(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "out.parquet")
+    with pytest.raises(RuntimeError):
+        with open_sink(path, flush_every=2) as sink:
+            for id, result in ROWS:
+                sink.write(id, result)
+            raise RuntimeError
+    ids = pq.read_table(path).column("id").to_pylist()
+    assert ids == ["a", "b", "c"]
+
+
+def test_csv_keeps_late_columns(tmp_path):
+    path = str(tmp_path / "out.csv")
+    _write(path)
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0]) == ["id", "CDRH1", "fv-H", "CDRL1", "fv-L", "nat_total"]
+    assert rows[0]["CDRL1"] == "" and rows[2]["CDRL1"] == "7.000"
+    assert math.isclose(float(rows[3]["CDRH1"]), 3.0)
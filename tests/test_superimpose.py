@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from ab_rmsd.backend import torch
+from ab_rmsd.superimpose import KabschRMSD
+
+ARRAY_TYPES = ["numpy"] + (["torch"] if torch is not None else [])
+
+
+def _degenerate_batch():
+    """a padded batch of rank deficient and near reflected items, and two ordinary ones."""
+    rng = np.random.default_rng(0)
+    B, N = 6, 8
+    tgt = rng.normal(size=(B, N, 3))
+    src = rng.normal(size=(B, N, 3))
+    mask = np.ones((B, N), dtype=bool)
+    # collinear
+    tgt[0] = np.outer(np.arange(N), [1, 2, 3])
+    src[0] = np.outer(np.arange(N), [3, 1, 0.5])
+    # two points
+    mask[1, 2:] = False
+    # coplanar
+    tgt[2, :, 2] = 0
+    src[2, :, 1] = 0
+    # three points, mirrored up to noise
+    mask[3, 3:] = False
+    src[3, :3] = tgt[3, :3] * [1, 1, -1] + 1e-9 * rng.normal(size=(3, 3))
+    return tgt, src, mask
+
+
+def _as(array_type, *xs):
+    if array_type == "torch":
+        return [torch.as_tensor(x) for x in xs]
+    return list(xs)
+
+
+@pytest.mark.parametrize("array_type", ARRAY_TYPES)
+def test_batch_rotations_are_proper(array_type):
+    tgt, src, mask = _as(array_type, *_degenerate_batch())
+    rotation, _ = KabschRMSD().batch_calc_superimpose_transformation(tgt, src, mask)
+    rotation = np.asarray(rotation)
+    np.testing.assert_allclose(np.linalg.det(rotation), 1.0, atol=1e-9)
+    np.testing.assert_allclose(
+        rotation @ np.swapaxes(rotation, -1, -2), np.broadcast_to(np.eye(3), rotation.shape), atol=1e-9
+    )
+
+
+@pytest.mark.parametrize("array_type", ARRAY_TYPES)
+def test_single_rotations_are_proper(array_type):
+    tgt, src, mask = _degenerate_batch()
+    for t, s, m in zip(tgt, src, mask):
+        t, s = _as(array_type, t[m], s[m])
+        rotation, _ = KabschRMSD().calc_superimpose_transformation(t, s)
+        np.testing.assert_allclose(np.linalg.det(np.asarray(rotation)), 1.0, atol=1e-9)